@@ -95,14 +95,56 @@ def get_tracking_script(source_type, source_name):
 
 # ---------- HELPERS ----------
 def _get_site_url():
+    # get_url() re-reads site config and the request each time;
+    # remember it on frappe.local for the rest of the request
+    site_url = getattr(frappe.local, "_cm_site_url", None)
+    if site_url:
+        return site_url
     try:
-        return frappe.utils.get_url()
+        site_url = frappe.local._cm_site_url = frappe.utils.get_url()
+        return site_url
     except Exception:
         try:
             return frappe.request.host_url
         except Exception:
             return ""
 
+# Rendered public pages, served from Redis by www/lp.py and www/forms.py.
+# Saving or deleting a Landing Page, its Landing Page Template, or a
+# Dynamic Form drops the affected entries (doc_events in hooks.py and
+# the DynamicForm controller).
+PAGE_HTML_TTL_SEC = 300
+
+
+def landing_page_html_key(slug):
+    return f"lp_html::{slug}"
+
+
+def dynamic_form_html_key(slug):
+    return f"form_html::{slug}"
+
+
+def clear_page_html(key_func, doc):
+    """Drop the cached HTML for doc's slug, and for its previous slug if it changed."""
+    slugs = {doc.get("slug")}
+    previous = doc.get_doc_before_save()
+    if previous:
+        slugs.add(previous.get("slug"))
+    for slug in filter(None, slugs):
+        frappe.cache().delete_value(key_func(slug))
+
+
+def on_landing_page_change(doc, method=None):
+    """Landing Page on_update / on_trash: drop its cached HTML."""
+    clear_page_html(landing_page_html_key, doc)
+
+
+def on_landing_page_template_change(doc, method=None):
+    """Landing Page Template on_update / on_trash: drop the cached HTML of every page using it."""
+    slugs = frappe.get_all("Landing Page", filters={"template": doc.name}, pluck="slug")
+    for slug in filter(None, slugs):
+        frappe.cache().delete_value(landing_page_html_key(slug))
+
 def _file_url(value):
     if not value:
         return ""
@@ -656,12 +698,16 @@ def get_public_url(name=None, docname=None, **kwargs):
     if not landing_page_name:
         frappe.throw("Landing Page name required")
 
-    doc = frappe.get_doc("Landing Page", landing_page_name)
-    if doc.status != "Published":
+    row = frappe.db.get_value(
+        "Landing Page", landing_page_name, ["status", "slug"], as_dict=True
+    )
+    if not row:
+        frappe.throw(f"Landing Page {landing_page_name} not found", frappe.DoesNotExistError)
+    if row.status != "Published":
         frappe.throw("Landing Page is not published")
 
-    site = frappe.utils.get_url()
-    url = f"{site}/lp/{doc.slug}"
+    site = _get_site_url()
+    url = f"{site}/lp/{row.slug}"
     return {"url": url}
 
 @frappe.whitelist(allow_guest=True)
@@ -1384,7 +1430,7 @@ def get_form_public_url(name=None, docname=None):
     if doc.status != "Published":
         frappe.throw("Form must be published first")
     
-    site_url = frappe.utils.get_url()
+    site_url = _get_site_url()
     public_url = f"{site_url.rstrip('/')}/forms/{doc.slug}"
 
     # Update published_url field
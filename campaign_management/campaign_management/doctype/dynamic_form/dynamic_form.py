@@ -4,6 +4,12 @@
 # import frappe
 from frappe.model.document import Document
 
+from campaign_management.api import clear_page_html, dynamic_form_html_key
+
 
 class DynamicForm(Document):
-	pass
+	def on_update(self):
+		clear_page_html(dynamic_form_html_key, self)
+
+	def on_trash(self):
+		clear_page_html(dynamic_form_html_key, self)
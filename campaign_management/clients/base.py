@@ -1,10 +1,30 @@
 import frappe
 from frappe.utils import now, format_datetime
+import functools
 import json
 import re
+import threading
+import time
+from collections import OrderedDict
 from urllib.parse import urlparse, parse_qs
 
 
+@functools.lru_cache(maxsize=2048)
+def parse_url(url):
+    """Memoised urlparse; ParseResult is immutable, so sharing it is safe."""
+    return urlparse(url)
+
+
+@functools.lru_cache(maxsize=2048)
+def url_query_params(url):
+    """
+    Memoised parse_qs of url's query string. page_url and referrer are
+    parsed by several helpers per request (ad click, UTM, Facebook), and
+    repeat across a visitor's events. Treat the returned dict as read-only.
+    """
+    return parse_qs(parse_url(url).query)
+
+
 def get_ad_click_data(data):
     ad_info = {
         'ad_platform': None,
@@ -41,8 +61,7 @@ def get_ad_click_data(data):
     page_url = data.get('page_url') or data.get('page_location') or ''
     if page_url and '?' in page_url:
         try:
-            parsed = urlparse(page_url)
-            query_params = parse_qs(parsed.query)
+            query_params = url_query_params(page_url)
             
             for param_name, platform_name in click_id_map.items():
                 if param_name in query_params:
@@ -64,8 +83,7 @@ def get_ad_click_data(data):
     referrer = data.get('referrer') or data.get('page_referrer') or ''
     if referrer and '?' in referrer:
         try:
-            parsed = urlparse(referrer)
-            query_params = parse_qs(parsed.query)
+            query_params = url_query_params(referrer)
             
             for param_name, platform_name in click_id_map.items():
                 if param_name in query_params:
@@ -90,11 +108,20 @@ def get_ad_click_data(data):
 
 
 def extract_browser_details(user_agent):
-    """Enhanced browser, OS, device detection with better accuracy"""
+    """
+    Enhanced browser, OS, device detection with better accuracy.
+    Memoised per process by User-Agent (truncated to 512 chars) — UA
+    strings repeat heavily, so most calls are a dict hit. The returned
+    dict is shared between callers: treat it as read-only.
+    """
+    return _parse_user_agent(str(user_agent or "")[:512])
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_user_agent(user_agent):
     if not user_agent:
         return {"browser": "Unknown", "os": "Unknown", "device": "Desktop", "user_agent": ""}
 
-    user_agent = str(user_agent)
     browser = "Unknown"
     os = "Unknown"
     device = "Desktop"
@@ -170,8 +197,45 @@ def extract_browser_details(user_agent):
     return {"browser": browser, "os": os, "device": device, "user_agent": user_agent}
 
 
+GEO_CACHE_SIZE = 10_000
+_GEO_CACHE = OrderedDict()
+_GEO_CACHE_LOCK = threading.Lock()
+
+
+def _geo_network(ip_address):
+    """Cache key for an IP: its /24 for IPv4 (neighbours share a location), else the IP."""
+    if ":" in ip_address:
+        return ip_address
+    return ip_address.rsplit(".", 1)[0]
+
+
 def get_geo_info_from_ip(ip_address):
-    """Get geographic info from IP"""
+    """
+    Get geographic info from IP.
+    Successful lookups are cached per process by /24 network (LRU, at most
+    GEO_CACHE_SIZE networks), so repeat visitors don't wait on ip-api.
+    The returned dict may be shared: treat it as read-only.
+    """
+    if not ip_address:
+        return _lookup_geo_info(ip_address)
+
+    network = _geo_network(ip_address)
+    with _GEO_CACHE_LOCK:
+        cached = _GEO_CACHE.get(network)
+        if cached is not None:
+            _GEO_CACHE.move_to_end(network)
+            return cached
+
+    geo_info = _lookup_geo_info(ip_address)
+    if geo_info.get('country'):
+        with _GEO_CACHE_LOCK:
+            _GEO_CACHE[network] = geo_info
+            if len(_GEO_CACHE) > GEO_CACHE_SIZE:
+                _GEO_CACHE.popitem(last=False)
+    return geo_info
+
+
+def _lookup_geo_info(ip_address):
     geo_info = {'country': None, 'country_code': None, 'region': None, 'city': None, 'latitude': None, 'longitude': None}
 
     try:
@@ -205,9 +269,13 @@ def get_geo_info_from_ip(ip_address):
 
 
 def ensure_web_visitor_has_device_field():
-    """Ensure Web Visitor doctype has device field"""
+    """
+    Ensure Web Visitor doctype has device field.
+    Checked against the site's cached DocType meta (standard or custom
+    field), so the common case is neither a query nor shared across sites.
+    """
     try:
-        if frappe.db.exists("Custom Field", {"dt": "Web Visitor", "fieldname": "device"}):
+        if frappe.get_meta("Web Visitor").has_field("device"):
             return True
 
         custom_field = frappe.get_doc({
@@ -231,47 +299,137 @@ def ensure_web_visitor_has_device_field():
         return False
 
 
+LAST_SEEN_THROTTLE_SEC = 30
+
+
+def should_touch_last_seen(visitor_name):
+    """
+    True at most once per LAST_SEEN_THROTTLE_SEC per visitor, so bursts of
+    scroll/click events don't each rewrite last_seen.
+    """
+    cache = frappe.cache()
+    # SET NX EX in one call — atomic, unlike SETNX followed by EXPIRE
+    return bool(cache.set(
+        cache.make_key(f"vseen:{visitor_name}"), 1,
+        ex=LAST_SEEN_THROTTLE_SEC, nx=True
+    ))
+
+
+VISITOR_FIELDS = ["name", "device", "converted_lead"]
+
+
 def get_or_create_web_visitor(client_id, data):
-    """Get existing or create new Web Visitor"""
+    """
+    Get existing or create new Web Visitor.
+    Returns the visitor row (name, device, converted_lead) as a frappe._dict,
+    read with a single query rather than exists() followed by get_doc().
+    Touches last_seen (throttled, see should_touch_last_seen) and device,
+    if it changed, in a single write.
+    Does not commit — the calling endpoint commits once at the end.
+    """
     ensure_web_visitor_has_device_field()
-    visitor_name = frappe.db.get_value("Web Visitor", {"client_id": client_id}, "name")
-
-    if visitor_name:
-        visitor = frappe.get_doc("Web Visitor", visitor_name)
+    visitor = frappe.db.get_value(
+        "Web Visitor", {"client_id": client_id}, VISITOR_FIELDS, as_dict=True
+    )
+
+    if visitor:
+        updates = {}
+        if should_touch_last_seen(visitor.name):
+            updates["last_seen"] = now()
         user_agent = data.get("user_agent") or ""
         if user_agent:
-            browser_details = extract_browser_details(user_agent)
-            current_device = browser_details['device']
-            try:
-                existing_device = getattr(visitor, 'device', None)
-                if existing_device != current_device:
-                    frappe.logger().info(f"Device update: {existing_device} to {current_device}")
-                    frappe.db.set_value("Web Visitor", visitor_name, "device", current_device, update_modified=False)
-            except Exception as e:
-                frappe.logger().warning(f"Device field not accessible: {str(e)}")
+            current_device = extract_browser_details(user_agent)['device']
+            if visitor.device != current_device:
+                frappe.logger().info(f"Device update: {visitor.device} to {current_device}")
+                updates["device"] = current_device
+        if updates:
+            frappe.db.set_value("Web Visitor", visitor.name, updates, update_modified=False)
     else:
         user_agent = data.get("user_agent") or ""
         browser_details = extract_browser_details(user_agent)
-        visitor_data = {
-            "doctype": "Web Visitor",
-            "client_id": client_id,
-            "website": data.get("page_url", "").split("?")[0] if data.get("page_url") else "",
-            "first_seen": now(),
-            "last_seen": now()
-        }
-        try:
-            visitor_data["device"] = browser_details['device']
-        except Exception:
-            frappe.logger().info("Device field not available")
+        page_url = data.get("page_url") or ""
+        visitor = upsert_web_visitor(
+            client_id, page_url.split("?")[0], browser_details['device']
+        )
+
+    return visitor
 
-        visitor = frappe.get_doc(visitor_data)
-        visitor.insert(ignore_permissions=True)
-        frappe.db.commit()
-        frappe.logger().info(f"Created Web Visitor: {visitor.name}")
 
+def upsert_web_visitor(client_id, website, device):
+    """
+    Insert the Web Visitor for client_id, or touch last_seen if a concurrent
+    request created it first. Relies on the UNIQUE index on client_id, so
+    two first-hits for the same visitor can't produce duplicate rows.
+    Returns the visitor row (VISITOR_FIELDS). Does not commit.
+    """
+    timestamp = now()
+    frappe.db.sql("""
+        INSERT INTO `tabWeb Visitor`
+            (name, client_id, website, device, first_seen, last_seen,
+             creation, modified, owner, modified_by, docstatus, idx)
+        VALUES
+            (%(name)s, %(client_id)s, %(website)s, %(device)s, %(ts)s, %(ts)s,
+             %(ts)s, %(ts)s, %(user)s, %(user)s, 0, 0)
+        ON DUPLICATE KEY UPDATE last_seen = VALUES(last_seen)
+    """, {
+        "name": frappe.generate_hash(length=10),
+        "client_id": client_id,
+        "website": website or "",
+        "device": device,
+        "ts": timestamp,
+        "user": frappe.session.user,
+    })
+    visitor = frappe.db.get_value(
+        "Web Visitor", {"client_id": client_id}, VISITOR_FIELDS, as_dict=True
+    )
+    frappe.logger().info(f"Upserted Web Visitor: {visitor.name}")
     return visitor
 
 
+LEADS_FOR_CLIENT_TTL_SEC = 3600
+
+
+def leads_for_client_key(client_id):
+    """Cache key for the lead names sharing a ga_client_id (see get_all_leads_for_client)."""
+    return f"leads_for:{client_id}"
+
+
+def clear_leads_for_client(client_id):
+    """
+    Drop the cached lead names for client_id once the current transaction
+    commits. Call it wherever a lead's ga_client_id is written; deleting
+    before the commit would let a concurrent request re-cache the old list.
+    """
+    if client_id:
+        key = leads_for_client_key(client_id)
+        frappe.db.after_commit.add(lambda: frappe.cache().delete_value(key))
+
+
+def on_lead_change(doc, method=None):
+    """CRM Lead on_update / on_trash: drop the cached leads for its ga_client_id."""
+    clear_leads_for_client(doc.get("ga_client_id"))
+    previous = doc.get_doc_before_save() if method == "on_update" else None
+    if previous and previous.get("ga_client_id") != doc.get("ga_client_id"):
+        clear_leads_for_client(previous.get("ga_client_id"))
+
+
+def add_lead_comment(lead_name, content, comment_type="Info"):
+    """
+    Comment on a CRM Lead without loading the lead: a direct db_insert of
+    the Comment instead of get_doc(lead).add_comment(), which also skips
+    the Comment insert hooks.
+    """
+    frappe.get_doc({
+        "doctype": "Comment",
+        "comment_type": comment_type,
+        "reference_doctype": "CRM Lead",
+        "reference_name": lead_name,
+        "comment_email": frappe.session.user,
+        "owner": frappe.session.user,
+        "content": content
+    }).db_insert()
+
+
 def link_web_visitor_to_lead(client_id, lead_name):
     """
     Links Web Visitor to a Lead.
@@ -280,8 +438,8 @@ def link_web_visitor_to_lead(client_id, lead_name):
     we don't need converted_lead to be accurate for activity routing.
     """
     try:
-        visitor_name = frappe.db.get_value(
-            "Web Visitor", {"client_id": client_id}, "name"
+        visitor_name = frappe.db.exists(
+            "Web Visitor", {"client_id": client_id}
         )
         if not visitor_name:
             return
@@ -317,131 +475,143 @@ def truncate_url(url, max_length=60):
     return f"{url[:40]}...{url[-10:]}", url
 
 
-def add_activity_to_lead(lead_name, activity_data):
+def build_activity_communication(lead_name, activity_data):
+    """
+    Build (but do not insert) the Communication for an activity.
+    Linked to the lead, or to the Web Visitor when there is no lead yet.
+    Returns None when neither a lead nor a client_id is available.
+    """
+    # Check if lead exists
+    if lead_name and frappe.db.exists("CRM Lead", lead_name):
+        reference_doctype = "CRM Lead"
+        reference_name = lead_name
+        lead_email = frappe.db.get_value("CRM Lead", lead_name, "email") or ""
+    else:
+        # Lead doesn't exist yet - link to Web Visitor instead
+        client_id = activity_data.get('client_id')
+        if not client_id:
+            frappe.logger().error("No lead and no client_id provided")
+            return None
+
+        visitor_name = frappe.db.exists("Web Visitor", {"client_id": client_id})
+        if not visitor_name:
+            ensure_web_visitor_has_device_field()
+            user_agent = activity_data.get('user_agent', '')
+            browser_details = extract_browser_details(user_agent)
+            page_url = activity_data.get("page_url") or ""
+            visitor_name = upsert_web_visitor(
+                client_id, page_url.split("?")[0], browser_details['device']
+            ).name
+
+        reference_doctype = "Web Visitor"
+        reference_name = visitor_name
+        lead_email = ""
+        frappe.logger().info(f"Storing activity for future lead (visitor: {visitor_name})")
+
+    return new_activity_communication(reference_doctype, reference_name, lead_email, activity_data)
+
+
+def new_activity_communication(reference_doctype, reference_name, lead_email, activity_data):
+    """
+    Build the activity Communication for an already-resolved reference.
+    No DB reads, so callers can resolve references for a whole batch first.
+    """
+    activity_type = activity_data.get('activity_type', 'Web Activity')
+    activity_type = re.sub(r'[^\w\s\-\(\)%]', '', activity_type).strip()
     
+    page_url = activity_data.get('page_url', '')
+    product_name = activity_data.get('product_name', '').strip()
+    cta_name = activity_data.get('cta_name', '')
+    cta_location = activity_data.get('cta_location', '')
+    cta_type = activity_data.get('cta_type', '')
+    browser = activity_data.get('browser', '')
+    device = activity_data.get('device', '')
+    geo_location = activity_data.get('geo_location', '')
+    referrer = activity_data.get('referrer', '')
+    utm_source = activity_data.get('utm_source')
+    utm_medium = activity_data.get('utm_medium')
+    utm_campaign = activity_data.get('utm_campaign')
+    fbclid = activity_data.get('fbclid')
+    utm_content = activity_data.get('utm_content')
+    lines = [f"<strong>{activity_type}</strong>"]
+
+    if fbclid:
+        fbclid_display = fbclid[:20] + '...' if len(fbclid) > 20 else fbclid
+        lines.append(f"<strong>Facebook Click ID:</strong> {fbclid_display}")    
+    if utm_campaign:
+        lines.append(f"<strong>Campaign:</strong> {utm_campaign}")        
+    if utm_content:
+        lines.append(f"<strong>Ad Creative:</strong> {utm_content}")      
+    if page_url:
+        display_url, full_url = truncate_url(page_url, 60)
+        lines.append(f"<strong>Page:</strong> <a href='{full_url}' target='_blank' title='{full_url}'>{display_url}</a>")
+    if cta_name:
+        lines.append(f"<strong>CTA:</strong> {cta_name}")
+    if cta_location:
+        lines.append(f"<strong>Location:</strong> {cta_location}")
+    if cta_type:
+        lines.append(f"<strong>Type:</strong> {cta_type}")
+    if product_name:
+        lines.append(f"<strong>Product:</strong> {product_name}")
+    
+    # Device & Browser info
+    device_info = []
+    if browser:
+        device_info.append(f"Browser: {browser}")
+    if device:
+        device_info.append(f"Device: {device}")
+    if geo_location:
+        device_info.append(f"Location: {geo_location}")
+    if device_info:
+        lines.append(" | ".join(device_info))
+
+    # Referrer with truncation
+    if referrer and referrer != "direct":
+        display_ref, full_ref = truncate_url(referrer, 60)
+        lines.append(f"<strong>Referrer:</strong> <a href='{full_ref}' target='_blank' title='{full_ref}'>{display_ref}</a>")
+
+    # UTM parameters
+    utm = []
+    if utm_source:
+        utm.append(f"Source: {utm_source}")
+    if utm_medium:
+        utm.append(f"Medium: {utm_medium}")
+    if utm_campaign:
+        utm.append(f"Campaign: {utm_campaign}")
+    if utm:
+        lines.append("<strong>UTM:</strong> " + " | ".join(utm))
+
+    content = "<br>".join(lines)
+
+    # Create Communication
+    comm = frappe.get_doc({
+        "doctype": "Communication",
+        "communication_type": "Communication",
+        "communication_medium": "Other",
+        "subject": activity_type + (f" - {cta_name}" if cta_name else ""),
+        "content": content,
+        "reference_doctype": reference_doctype,
+        "reference_name": reference_name,
+        "status": "Linked",
+        "sent_or_received": "Received",
+        "recipients": lead_email,
+        "communication_date": activity_data.get('timestamp') or now()
+    })
+    return comm
+
+
+def add_activity_to_lead(lead_name, activity_data):
+    """
+    Store an activity as a Communication on the lead (or on the Web Visitor
+    when there is no lead yet). Callers are responsible for committing.
+    """
     try:
-        # Check if lead exists
-        if lead_name and frappe.db.exists("CRM Lead", lead_name):
-            reference_doctype = "CRM Lead"
-            reference_name = lead_name
-            lead_email = frappe.db.get_value("CRM Lead", lead_name, "email") or ""
-        else:
-            # Lead doesn't exist yet - link to Web Visitor instead
-            client_id = activity_data.get('client_id')
-            if not client_id:
-                frappe.logger().error("No lead and no client_id provided")
-                return False
-
-            visitor_name = frappe.db.get_value("Web Visitor", {"client_id": client_id}, "name")
-            if not visitor_name:
-                user_agent = activity_data.get('user_agent', '')
-                browser_details = extract_browser_details(user_agent)
-                page_url = activity_data.get("page_url", "")
-                visitor = frappe.get_doc({
-                    "doctype": "Web Visitor",
-                    "client_id": client_id,
-                    "website": page_url.split("?")[0] if page_url else "",
-                    "first_seen": now(),
-                    "last_seen": now()
-                })
-                try:
-                    visitor.device = browser_details['device']
-                except:
-                    pass
-                visitor.insert(ignore_permissions=True)
-                frappe.db.commit()
-                visitor_name = visitor.name
-                frappe.logger().info(f"Created Web Visitor: {visitor_name}")
-
-            reference_doctype = "Web Visitor"
-            reference_name = visitor_name
-            lead_email = ""
-            frappe.logger().info(f"Storing activity for future lead (visitor: {visitor_name})")
-
-        activity_type = activity_data.get('activity_type', 'Web Activity')
-        activity_type = re.sub(r'[^\w\s\-\(\)%]', '', activity_type).strip()
-        
-        page_url = activity_data.get('page_url', '')
-        product_name = activity_data.get('product_name', '').strip()
-        cta_name = activity_data.get('cta_name', '')
-        cta_location = activity_data.get('cta_location', '')
-        cta_type = activity_data.get('cta_type', '')
-        browser = activity_data.get('browser', '')
-        device = activity_data.get('device', '')
-        geo_location = activity_data.get('geo_location', '')
-        referrer = activity_data.get('referrer', '')
-        utm_source = activity_data.get('utm_source')
-        utm_medium = activity_data.get('utm_medium')
-        utm_campaign = activity_data.get('utm_campaign')
-        fbclid = activity_data.get('fbclid')
-        utm_content = activity_data.get('utm_content')
-        lines = [f"<strong>{activity_type}</strong>"]
-
-        if fbclid:
-            fbclid_display = fbclid[:20] + '...' if len(fbclid) > 20 else fbclid
-            lines.append(f"<strong>Facebook Click ID:</strong> {fbclid_display}")    
-        if utm_campaign:
-            lines.append(f"<strong>Campaign:</strong> {utm_campaign}")        
-        if utm_content:
-            lines.append(f"<strong>Ad Creative:</strong> {utm_content}")      
-        if page_url:
-            display_url, full_url = truncate_url(page_url, 60)
-            lines.append(f"<strong>Page:</strong> <a href='{full_url}' target='_blank' title='{full_url}'>{display_url}</a>")
-        if cta_name:
-            lines.append(f"<strong>CTA:</strong> {cta_name}")
-        if cta_location:
-            lines.append(f"<strong>Location:</strong> {cta_location}")
-        if cta_type:
-            lines.append(f"<strong>Type:</strong> {cta_type}")
-        if product_name:
-            lines.append(f"<strong>Product:</strong> {product_name}")
-        
-        # Device & Browser info
-        device_info = []
-        if browser:
-            device_info.append(f"Browser: {browser}")
-        if device:
-            device_info.append(f"Device: {device}")
-        if geo_location:
-            device_info.append(f"Location: {geo_location}")
-        if device_info:
-            lines.append(" | ".join(device_info))
-
-        # Referrer with truncation
-        if referrer and referrer != "direct":
-            display_ref, full_ref = truncate_url(referrer, 60)
-            lines.append(f"<strong>Referrer:</strong> <a href='{full_ref}' target='_blank' title='{full_ref}'>{display_ref}</a>")
-
-        # UTM parameters
-        utm = []
-        if utm_source:
-            utm.append(f"Source: {utm_source}")
-        if utm_medium:
-            utm.append(f"Medium: {utm_medium}")
-        if utm_campaign:
-            utm.append(f"Campaign: {utm_campaign}")
-        if utm:
-            lines.append("<strong>UTM:</strong> " + " | ".join(utm))
-
-        content = "<br>".join(lines)
-
-        # Create Communication
-        comm = frappe.get_doc({
-            "doctype": "Communication",
-            "communication_type": "Communication",
-            "communication_medium": "Other",
-            "subject": activity_type + (f" - {cta_name}" if cta_name else ""),
-            "content": content,
-            "reference_doctype": reference_doctype,
-            "reference_name": reference_name,
-            "status": "Linked",
-            "sent_or_received": "Received",
-            "recipients": lead_email
-        })
+        comm = build_activity_communication(lead_name, activity_data)
+        if not comm:
+            return False
         comm.insert(ignore_permissions=True)
-        frappe.db.commit()
 
-        frappe.logger().info(f"Activity saved: {comm.name} for {reference_doctype} {reference_name}")
+        frappe.logger().info(f"Activity saved: {comm.name} for {comm.reference_doctype} {comm.reference_name}")
         return True
 
     except Exception as e:
@@ -451,12 +621,16 @@ def add_activity_to_lead(lead_name, activity_data):
 
 
 def link_historical_activities_to_lead(client_id, lead_name):
-    """Link all visitor activities to lead"""
+    """
+    Link all visitor activities to lead.
+    Runs inside the caller's transaction; a failure rolls back to a
+    savepoint so a half-done relink never gets committed with it.
+    """
+    frappe.db.savepoint("link_historical_activities")
     try:
-        visitor_name = frappe.db.get_value(
+        visitor_name = frappe.db.exists(
             "Web Visitor",
-            {"client_id": client_id},
-            "name"
+            {"client_id": client_id}
         )
         if not visitor_name:
             return
@@ -481,12 +655,112 @@ def link_historical_activities_to_lead(client_id, lead_name):
         )
 
     except Exception as e:
+        frappe.db.rollback(save_point="link_historical_activities")
         frappe.log_error(
             frappe.get_traceback(),
             "Link Historical Activities Failed"
         )
 
 
+def get_request_data():
+    """
+    Request payload as a dict, parsed once.
+    form_dict already carries the query string plus a form or JSON body
+    (Frappe parses both by Content-Type), so it is copied as-is; only a
+    body sent with some other Content-Type (e.g. navigator.sendBeacon's
+    text/plain) is parsed here as JSON.
+    """
+    data = {}
+    try:
+        data.update(frappe.local.form_dict or {})
+        request = getattr(frappe.local, "request", None)
+        content_type = (request.content_type or "") if request is not None else ""
+        if request is not None and "json" not in content_type and "form" not in content_type and request.data:
+            body = request.get_json(force=True, silent=True)
+            if isinstance(body, dict):
+                data.update(body)
+        frappe.logger().debug("📦 Request data (%s): %s", content_type, data)
+    except Exception as e:
+        frappe.logger().error("Error reading request data: %s", e)
+    return data
+
+
+def capture_request_context(data):
+    """
+    Copy request-bound values (User-Agent, client IP) into the payload,
+    since they are gone once the payload is handed to a background job.
+    """
+    data["user_agent"] = str(
+        data.get("user_agent") or
+        frappe.get_request_header("User-Agent", "") or ""
+    )
+    data["ip_address"] = str(
+        data.get("ip_address") or
+        frappe.local.request_ip or ""
+    )
+    return data
+
+
+TRACKING_JOB_RESULT_TTL_SEC = 3600
+
+
+def tracking_job_result_key(ref):
+    return f"tracking_job:{ref}"
+
+
+def enqueue_tracking_job(method, data, client_id, prefix, **kwargs):
+    """
+    Run method(data, **kwargs) on the short queue, or inline when
+    campaign_sync_activity_writes is set in site config (e.g. no workers).
+    The queued response carries a job_id; the job's own result (lead,
+    is_new_lead, or the failure message) can be read back with
+    get_tracking_job_result.
+    """
+    if frappe.conf.get("campaign_sync_activity_writes"):
+        return method(data, **kwargs)
+
+    ref = f"{prefix}:{client_id}:{frappe.generate_hash(length=8)}"
+    # Hand the job to the worker only once this request's writes are
+    # committed, so it never reads ahead of them
+    frappe.enqueue(
+        "campaign_management.clients.base.run_tracking_job",
+        queue="short",
+        job_name=ref,
+        enqueue_after_commit=True,
+        target=f"{method.__module__}.{method.__name__}",
+        ref=ref,
+        client_id=client_id,
+        data=data,
+        **kwargs
+    )
+    return {"success": True, "queued": True, "job_id": ref}
+
+
+def run_tracking_job(target, ref, client_id, data, **kwargs):
+    """
+    Background side of enqueue_tracking_job: run target, keep its result
+    for get_tracking_job_result, and put any failure in the Error Log
+    under the job ref (which carries the client_id).
+    """
+    try:
+        result = frappe.get_attr(target)(data, **kwargs)
+    except Exception:
+        frappe.db.rollback()
+        frappe.log_error(frappe.get_traceback(), f"Tracking Job Failed: {ref}")
+        result = {"success": False, "message": "Processing failed"}
+    else:
+        if not (result or {}).get("success"):
+            frappe.log_error(
+                f"client_id={client_id}\n{json.dumps(result, default=str)}",
+                f"Tracking Job Failed: {ref}"
+            )
+
+    frappe.cache().set_value(
+        tracking_job_result_key(ref), result, expires_in_sec=TRACKING_JOB_RESULT_TTL_SEC
+    )
+    return result
+
+
 def get_utm_params_from_data(data):
     """Extract UTM parameters from request data"""
     utm_params = {
@@ -510,8 +784,7 @@ def get_utm_params_from_data(data):
     page_url = data.get('page_url') or data.get('page_location') or ''
     if page_url and '?' in page_url:
         try:
-            parsed = urlparse(page_url)
-            query_params = parse_qs(parsed.query)
+            query_params = url_query_params(page_url)
             for utm_key in utm_params.keys():
                 if not utm_params[utm_key] and utm_key in query_params:
                     utm_params[utm_key] = query_params[utm_key][0].strip()
@@ -526,8 +799,7 @@ def get_utm_params_from_data(data):
     referrer = data.get('referrer') or data.get('page_referrer') or ''
     if referrer and '?' in referrer:
         try:
-            parsed = urlparse(referrer)
-            query_params = parse_qs(parsed.query)
+            query_params = url_query_params(referrer)
             for utm_key in utm_params.keys():
                 if not utm_params[utm_key] and utm_key in query_params:
                     utm_params[utm_key] = query_params[utm_key][0].strip()
@@ -573,9 +845,7 @@ def get_facebook_ad_data(data):
         page_url = data.get('page_url') or data.get('page_location') or ''
         if 'fbclid=' in page_url:
             try:
-                from urllib.parse import urlparse, parse_qs
-                parsed = urlparse(page_url)
-                params = parse_qs(parsed.query)
+                params = url_query_params(page_url)
                 if 'fbclid' in params:
                     fbclid = params['fbclid'][0].strip()
                     fb_data['has_facebook_click'] = True
@@ -596,6 +866,7 @@ def track_facebook_ad_click(client_id, data, org_name):
     """
     Track Facebook ad click as activity
     Works for both anonymous visitors and existing leads
+    Does not commit — the calling endpoint commits once at the end.
     """
     try:
         fb_data = get_facebook_ad_data(data)
@@ -613,10 +884,9 @@ def track_facebook_ad_click(client_id, data, org_name):
         else:
             # Try to find by client_id
             try:
-                lead_name = frappe.db.get_value(
+                lead_name = frappe.db.exists(
                     "CRM Lead",
-                    {"ga_client_id": client_id, "organization": org_name},
-                    "name"
+                    {"ga_client_id": client_id, "organization": org_name}
                 )
             except:
                 pass
@@ -658,7 +928,6 @@ def track_facebook_ad_click(client_id, data, org_name):
         
         # Add activity (to lead if exists, to visitor if not)
         add_activity_to_lead(lead_name, activity_data)
-        frappe.db.commit()
         
         if lead_name:
             frappe.logger().info(f"✅ Facebook ad click tracked for lead: {lead_name}")
@@ -5,58 +5,47 @@ import frappe
 from frappe.utils import now, format_datetime
 import json
 from campaign_management.clients.base import (
+    get_request_data,
+    capture_request_context,
+    enqueue_tracking_job,
     extract_browser_details,
     get_geo_info_from_ip,
     get_or_create_web_visitor,
     link_web_visitor_to_lead,
     add_activity_to_lead,
     get_utm_params_from_data,
-    link_historical_activities_to_lead
+    link_historical_activities_to_lead,
+    add_lead_comment,
+    clear_leads_for_client
 )
 
 
-def get_request_data():
-    """Safely extract data from various request formats"""
-    data = {}
-    
-    try:
-        # Method 1: form_dict
-        if frappe.local.form_dict:
-            data.update(frappe.local.form_dict)
-            frappe.logger().info(f"📦 Data from form_dict: {json.dumps(data, indent=2)}")
-    except Exception as e:
-        frappe.logger().error(f"Error reading form_dict: {str(e)}")
-    
-    try:
-        # Method 2: request.form
-        if hasattr(frappe.local, 'request') and hasattr(frappe.local.request, 'form'):
-            form_data = dict(frappe.local.request.form)
-            data.update(form_data)
-            frappe.logger().info(f"📦 Data from request.form: {json.dumps(form_data, indent=2)}")
-    except Exception as e:
-        frappe.logger().error(f"Error reading request.form: {str(e)}")
-    
-    try:
-        # Method 3: JSON body
-        if hasattr(frappe.local, 'request') and frappe.local.request.data:
-            json_body = frappe.local.request.get_json(silent=True)
-            if json_body:
-                data.update(json_body)
-                frappe.logger().info(f"📦 Data from JSON body: {json.dumps(json_body, indent=2)}")
-    except Exception as e:
-        frappe.logger().error(f"Error reading JSON body: {str(e)}")
-    
+# (site, CRM Organization) pairs known to exist, per process; keyed by
+# site so one site's org never stands in for another's on a shared bench
+_KNOWN_CRM_ORGS = set()
+
+
+def ensure_crm_organization(org_name, website):
+    """
+    Create the CRM Organization if missing. After the first call per site
+    and process this is a set lookup; the first call is a single insert
+    that tolerates the row already existing, instead of exists() followed
+    by insert(). The org is only remembered once the insert is committed.
+    """
+    known = (frappe.local.site, org_name)
+    if known in _KNOWN_CRM_ORGS:
+        return
     try:
-        # Method 4: Raw data (for debugging)
-        if hasattr(frappe.local, 'request') and frappe.local.request.data:
-            raw_data = frappe.local.request.data
-            if isinstance(raw_data, bytes):
-                raw_data = raw_data.decode('utf-8')
-            frappe.logger().info(f"📦 Raw request data: {raw_data}")
-    except Exception as e:
-        frappe.logger().error(f"Error reading raw data: {str(e)}")
-    
-    return data
+        org = frappe.get_doc({
+            "doctype": "CRM Organization",
+            "organization_name": org_name,
+            "website": website
+        })
+        org.insert(ignore_permissions=True, ignore_if_duplicate=True)
+        frappe.logger().info("✅ Organization ensured: %s", org_name)
+    except frappe.DuplicateEntryError:
+        pass
+    frappe.db.after_commit.add(lambda: _KNOWN_CRM_ORGS.add(known))
 
 
 @frappe.whitelist(allow_guest=True, methods=['POST'])
@@ -74,7 +63,7 @@ def submit_form(**kwargs):
         data = get_request_data()
         data.update(kwargs)
 
-        frappe.logger().info(f"📊 Combined data: {json.dumps(data, indent=2)}")
+        frappe.logger().debug("📊 Combined data: %s", data)
 
         # Extract fields - handle both direct values and stringified JSON
         full_name = str(data.get("full_name") or "").strip()
@@ -89,7 +78,7 @@ def submit_form(**kwargs):
         cart_total = data.get("cart_total", 0)
         cta_source = str(data.get("cta_source") or "Direct Visit")
 
-        frappe.logger().info(f"✅ Extracted: name={full_name}, email={email}, phone={phone}, client_id={client_id}")
+        frappe.logger().info("✅ Extracted: name=%s, email=%s, phone=%s, client_id=%s", full_name, email, phone, client_id)
 
         # Validation
         if not full_name:
@@ -106,7 +95,7 @@ def submit_form(**kwargs):
         page_url = str(data.get("page_url") or "")
         referrer = str(data.get("referrer") or "")
 
-        frappe.logger().info(f"🌐 Tracking: UA={user_agent[:50]}..., IP={ip_address}")
+        frappe.logger().info("🌐 Tracking: UA=%s..., IP=%s", user_agent[:50], ip_address)
 
         browser_details = extract_browser_details(user_agent)
         geo_info = get_geo_info_from_ip(ip_address)
@@ -138,15 +127,7 @@ def submit_form(**kwargs):
 
         # Check/Create Organization
         org_name = "QuickShop"
-        if not frappe.db.exists("CRM Organization", org_name):
-            org = frappe.get_doc({
-                "doctype": "CRM Organization",
-                "organization_name": org_name,
-                "website": "quickshop-4f6f5.web.app"
-            })
-            org.insert(ignore_permissions=True)
-            frappe.db.commit()
-            frappe.logger().info(f"✅ Created organization: {org_name}")
+        ensure_crm_organization(org_name, "quickshop-4f6f5.web.app")
 
         # Check for existing lead
         existing_lead = None
@@ -155,43 +136,48 @@ def submit_form(**kwargs):
             try:
                 existing_lead = frappe.db.get_value(
                     "CRM Lead", {"ga_client_id": client_id},
-                    ["name", "email", "mobile_no"], as_dict=True
+                    ["name", "email", "mobile_no", "ga_client_id", "organization"], as_dict=True
                 )
                 if existing_lead:
-                    frappe.logger().info(f"✅ Found existing lead by client_id: {existing_lead.name}")
+                    frappe.logger().info("✅ Found existing lead by client_id: %s", existing_lead.name)
             except Exception as e:
-                frappe.logger().error(f"Error checking lead by client_id: {str(e)}")
+                frappe.logger().error("Error checking lead by client_id: %s", e)
 
         if not existing_lead and email:
             try:
                 existing_lead = frappe.db.get_value(
                     "CRM Lead", {"email": email},
-                    ["name", "email", "mobile_no"], as_dict=True
+                    ["name", "email", "mobile_no", "ga_client_id", "organization"], as_dict=True
                 )
                 if existing_lead:
-                    frappe.logger().info(f"✅ Found existing lead by email: {existing_lead.name}")
+                    frappe.logger().info("✅ Found existing lead by email: %s", existing_lead.name)
             except Exception as e:
-                frappe.logger().error(f"Error checking lead by email: {str(e)}")
+                frappe.logger().error("Error checking lead by email: %s", e)
 
         if existing_lead:
             # UPDATE EXISTING LEAD - RECORD NEW ORDER
-            frappe.logger().info(f"🔄 Recording new order for existing lead: {existing_lead.name}")
+            frappe.logger().info("🔄 Recording new order for existing lead: %s", existing_lead.name)
 
-            lead = frappe.get_doc("CRM Lead", existing_lead.name)
+            lead = existing_lead
 
-            # Update contact info if missing
+            # Update contact info if missing — only these fields can change,
+            # so write them directly instead of loading and saving the lead
+            updates = {}
             if email and not lead.email:
-                lead.email = email
+                updates["email"] = email
             if phone and not lead.mobile_no:
-                lead.mobile_no = phone
+                updates["mobile_no"] = phone
             if client_id and not lead.ga_client_id:
-                lead.ga_client_id = client_id
+                updates["ga_client_id"] = client_id
             if not lead.organization:
-                lead.organization = org_name
+                updates["organization"] = org_name
+            if updates:
+                frappe.db.set_value("CRM Lead", lead.name, updates)
+                if "ga_client_id" in updates:
+                    clear_leads_for_client(client_id)
 
             # Add order comment
-            lead.add_comment("Info", f"🛒 New Order Placed<br>Items: {cart_items}<br>Total: ₹{cart_total}<br>Via: {cta_source}")
-            lead.save(ignore_permissions=True)
+            add_lead_comment(lead.name, f"🛒 New Order Placed<br>Items: {cart_items}<br>Total: ₹{cart_total}<br>Via: {cta_source}")
 
             # Add ORDER activity (not resubmission)
             add_activity_to_lead(lead.name, {
@@ -209,7 +195,7 @@ def submit_form(**kwargs):
             })
 
             frappe.db.commit()
-            frappe.logger().info(f"✅ Order recorded for lead: {lead.name}")
+            frappe.logger().info("✅ Order recorded for lead: %s", lead.name)
 
             return {
                 "success": True,
@@ -219,7 +205,7 @@ def submit_form(**kwargs):
 
         else:
             # CREATE NEW LEAD
-            frappe.logger().info(f"➕ Creating new lead for: {full_name}")
+            frappe.logger().info("➕ Creating new lead for: %s", full_name)
 
             name_parts = full_name.strip().split(maxsplit=1)
             first_name = name_parts[0] if name_parts else full_name
@@ -239,13 +225,12 @@ def submit_form(**kwargs):
                 "utm_source": utm_params.get('utm_source'),
                 "utm_medium": utm_params.get('utm_medium'),
                 "utm_campaign": utm_params.get('utm_campaign'),
-                "full_tracking_details": json.dumps(complete_tracking_data, indent=2)
+                "full_tracking_details": json.dumps(complete_tracking_data, separators=(",", ":"), default=str)
             })
 
             lead.insert(ignore_permissions=True)
-            frappe.db.commit()
 
-            frappe.logger().info(f"✅ Lead created: {lead.name} with org: {org_name}")
+            frappe.logger().info("✅ Lead created: %s with org: %s", lead.name, org_name)
 
             # Link Web Visitor
             if client_id:
@@ -277,8 +262,8 @@ def submit_form(**kwargs):
 
     except Exception as e:
         frappe.logger().error("=" * 80)
-        frappe.logger().error(f"❌ FORM SUBMISSION ERROR: {str(e)}")
-        frappe.logger().error(f"❌ Traceback: {frappe.get_traceback()}")
+        frappe.logger().error("❌ FORM SUBMISSION ERROR: %s", e)
+        frappe.logger().error("❌ Traceback: %s", frappe.get_traceback())
         frappe.logger().error("=" * 80)
         frappe.log_error(frappe.get_traceback(), "QuickShop Form Error")
 
@@ -292,20 +277,44 @@ def submit_form(**kwargs):
 
 @frappe.whitelist(allow_guest=True, methods=['POST'])
 def track_activity(**kwargs):
-    """Track user activity - page views, clicks, scrolls, etc."""
+    """
+    Track user activity - page views, clicks, scrolls, etc.
+    Validates the event and queues it; the writes happen in
+    _process_activity on a background job.
+    """
     frappe.set_user("Guest")
     frappe.flags.ignore_csrf = True
-    
+
+    try:
+        data = get_request_data()
+        data.update(kwargs)
+
+        client_id = data.get("client_id")
+        if not client_id:
+            return {"success": False, "message": "client_id is required"}
+        if not data.get("activity_type"):
+            return {"success": False, "message": "activity_type is required"}
+
+        capture_request_context(data)
+        return enqueue_tracking_job(_process_activity, data, client_id, "qs-act")
+
+    except Exception as e:
+        frappe.logger().error("❌ ACTIVITY TRACKING ERROR: %s", e)
+        frappe.log_error(frappe.get_traceback(), "QuickShop Activity Error")
+        return {"success": False, "message": f"Error: {str(e)}"}
+
+
+def _process_activity(data):
+    """
+    QuickShop activity write (runs on the short queue).
+    Expects data to have been through capture_request_context.
+    """
     try:
         frappe.logger().info("=" * 80)
         frappe.logger().info("📊 ACTIVITY TRACKING REQUEST RECEIVED")
         frappe.logger().info("=" * 80)
-        
-        # Get data from all possible sources
-        data = get_request_data()
-        data.update(kwargs)
-        
-        frappe.logger().info(f"📊 Combined data: {json.dumps(data, indent=2)}")
+
+        frappe.logger().debug("📊 Combined data: %s", data)
 
         # Extract required fields
         client_id = data.get("client_id")
@@ -315,7 +324,7 @@ def track_activity(**kwargs):
         cta_name = str(data.get("cta_name") or "")
         percent_scrolled = data.get("percent_scrolled", "")
 
-        frappe.logger().info(f"✅ Extracted: client_id={client_id}, activity={activity_type}")
+        frappe.logger().info("✅ Extracted: client_id=%s, activity=%s", client_id, activity_type)
 
         if not client_id:
             frappe.logger().error("❌ Validation failed: client_id is required")
@@ -335,11 +344,11 @@ def track_activity(**kwargs):
             else:
                 activity_type = f"📜 Scroll {percent_scrolled}%"
             
-            frappe.logger().info(f"📜 Processed scroll event: {activity_type}")
+            frappe.logger().info("📜 Processed scroll event: %s", activity_type)
 
         # Get tracking info - SERVER-SIDE
-        user_agent = str(data.get("user_agent") or frappe.get_request_header("User-Agent", ""))
-        ip_address = str(data.get("ip_address") or frappe.local.request_ip or "")
+        user_agent = data.get("user_agent") or ""
+        ip_address = data.get("ip_address") or ""
         referrer = str(data.get("referrer") or "")
         
         browser_details = extract_browser_details(user_agent)
@@ -354,28 +363,27 @@ def track_activity(**kwargs):
 
         # Get or create visitor
         visitor = get_or_create_web_visitor(client_id, data)
-        frappe.db.set_value("Web Visitor", visitor.name, "last_seen", now(), update_modified=False)
-        frappe.logger().info(f"✅ Visitor: {visitor.name}")
+        frappe.logger().info("✅ Visitor: %s", visitor.name)
 
         # Find linked lead
         lead_name = None
         
         if visitor.converted_lead:
             lead_name = visitor.converted_lead
-            frappe.logger().info(f"✅ Found lead from visitor.converted_lead: {lead_name}")
+            frappe.logger().info("✅ Found lead from visitor.converted_lead: %s", lead_name)
 
         if not lead_name and client_id:
             try:
-                lead_name = frappe.db.get_value("CRM Lead", {"ga_client_id": client_id}, "name")
+                lead_name = frappe.db.exists("CRM Lead", {"ga_client_id": client_id})
                 if lead_name:
-                    frappe.logger().info(f"✅ Found existing lead by ga_client_id: {lead_name}")
+                    frappe.logger().info("✅ Found existing lead by ga_client_id: %s", lead_name)
                     link_web_visitor_to_lead(client_id, lead_name)
             except Exception as e:
-                frappe.logger().error(f"Error finding lead: {str(e)}")
+                frappe.logger().error("Error finding lead: %s", e)
 
         # Add activity
         if lead_name:
-            frappe.logger().info(f"📝 Adding activity to lead: {lead_name}")
+            frappe.logger().info("📝 Adding activity to lead: %s", lead_name)
             success = add_activity_to_lead(lead_name, {
                 "activity_type": activity_type,
                 "page_url": page_url,
@@ -391,7 +399,7 @@ def track_activity(**kwargs):
             })
             frappe.db.commit()
             
-            frappe.logger().info(f"✅ Activity saved to lead: {success}")
+            frappe.logger().info("✅ Activity saved to lead: %s", success)
             
             return {
                 "success": True,
@@ -401,7 +409,7 @@ def track_activity(**kwargs):
             }
         else:
             # No lead yet - store activity linked to Web Visitor
-            frappe.logger().info(f"📝 No lead yet, storing activity for visitor: {visitor.name}")
+            frappe.logger().info("📝 No lead yet, storing activity for visitor: %s", visitor.name)
             
             success = add_activity_to_lead(None, {
                 "activity_type": activity_type,
@@ -418,7 +426,7 @@ def track_activity(**kwargs):
             })
             frappe.db.commit()
             
-            frappe.logger().info(f"✅ Activity saved to visitor: {success}")
+            frappe.logger().info("✅ Activity saved to visitor: %s", success)
             
             return {
                 "success": True,
@@ -430,8 +438,8 @@ def track_activity(**kwargs):
 
     except Exception as e:
         frappe.logger().error("=" * 80)
-        frappe.logger().error(f"❌ ACTIVITY TRACKING ERROR: {str(e)}")
-        frappe.logger().error(f"❌ Traceback: {frappe.get_traceback()}")
+        frappe.logger().error("❌ ACTIVITY TRACKING ERROR: %s", e)
+        frappe.logger().error("❌ Traceback: %s", frappe.get_traceback())
         frappe.logger().error("=" * 80)
         frappe.log_error(frappe.get_traceback(), "Activity Tracking Error")
         
@@ -3,10 +3,17 @@ Universal Tracker - FIXED VERSION WITH ENHANCED DEBUGGING
 """
 import frappe
 from frappe.utils import now
+import functools
 import json
 import hashlib
-from urllib.parse import urlparse, parse_qs
+import re
 from campaign_management.clients.base import (
+    get_request_data,
+    capture_request_context,
+    enqueue_tracking_job,
+    tracking_job_result_key,
+    parse_url,
+    add_lead_comment,
     extract_browser_details,
     get_geo_info_from_ip,
     get_or_create_web_visitor,
@@ -15,7 +22,14 @@ from campaign_management.clients.base import (
     get_utm_params_from_data,
     link_historical_activities_to_lead,
     get_ad_click_data,
-    send_capi_event  
+    get_facebook_ad_data,
+    enrich_lead_with_facebook_data,
+    track_facebook_ad_click,
+    new_activity_communication,
+    send_capi_event,
+    leads_for_client_key,
+    clear_leads_for_client,
+    LEADS_FOR_CLIENT_TTL_SEC
 )
 
 
@@ -50,6 +64,7 @@ def get_all_tracking_organizations():
                 org_name = org.crm_organization if org.crm_organization else org.organization_name
                 
                 org_map[org.tracking_key.lower()] = {
+                    "tracking_key": org.tracking_key.lower(),
                     "org_name": org_name,
                     "org_website": domains[0] if domains else "",
                     "type": org.org_type or "other",
@@ -76,12 +91,16 @@ def get_all_tracking_organizations():
         return {}
 
 
+ORG_CONFIG_CACHE_KEY = "tracking_organizations_config"
+ORG_CONFIG_VERSION_KEY = "tracking_organizations_config_version"
+
+
 def get_organization_config_cached():
     """
     Get organization config with caching.
     Cache expires every 5 minutes to pick up new orgs automatically.
     """
-    cache_key = "tracking_organizations_config"
+    cache_key = ORG_CONFIG_CACHE_KEY
     cached_config = frappe.cache().get_value(cache_key)
     
     if cached_config:
@@ -95,6 +114,9 @@ def get_organization_config_cached():
     # Cache for 5 minutes (300 seconds)
     if config:
         frappe.cache().set_value(cache_key, config, expires_in_sec=300)
+        # New version on every reload: per-process indexes keyed by it
+        # (see _config_epoch) are rebuilt on every worker
+        frappe.cache().set_value(ORG_CONFIG_VERSION_KEY, frappe.generate_hash(length=10), expires_in_sec=300)
         frappe.logger().info(f"Cached {len(config)} organizations for 5 minutes")
     
     return config
@@ -105,7 +127,10 @@ def clear_organization_cache():
     Clear the organization config cache.
     Call this when Tracking Organization docs are created/updated.
     """
-    frappe.cache().delete_value("tracking_organizations_config")
+    frappe.cache().delete_value([ORG_CONFIG_CACHE_KEY, ORG_CONFIG_VERSION_KEY])
+    _get_organization_index.cache_clear()
+    _identify_cached.cache_clear()
+    frappe.cache().delete_value("known_orgs")
     frappe.logger().info("Organization config cache cleared")
     
     
@@ -136,10 +161,7 @@ def get_org_config(**kwargs):
         data = get_request_data()
         data.update(kwargs)
         
-        tracking_key = str(
-            data.get("tracking_key") or
-            data.get("key") or ""
-        ).lower().strip()
+        tracking_key = _first(data, "tracking_key", "key").lower().strip()
         
         if not tracking_key:
             return {"success": False, "message": "tracking_key is required"}
@@ -148,7 +170,7 @@ def get_org_config(**kwargs):
         cache_key = f"org_config_api_{tracking_key}"
         cached = frappe.cache().get_value(cache_key)
         if cached:
-            frappe.logger().debug(f"[get_org_config] Cache hit for: {tracking_key}")
+            frappe.logger().debug("[get_org_config] Cache hit for: %s", tracking_key)
             return cached
         
         # Fetch from Tracking Organization
@@ -169,7 +191,7 @@ def get_org_config(**kwargs):
         )
         
         if not org:
-            frappe.logger().error(f"[get_org_config] No active org for key: {tracking_key}")
+            frappe.logger().error("[get_org_config] No active org for key: %s", tracking_key)
             return {"success": False, "message": f"Unknown tracking_key: {tracking_key}"}
         
         result = {
@@ -185,12 +207,12 @@ def get_org_config(**kwargs):
         
         # Cache for 10 minutes
         frappe.cache().set_value(cache_key, result, expires_in_sec=600)
-        frappe.logger().info(f"[get_org_config] Served config for: {tracking_key}")
+        frappe.logger().info("[get_org_config] Served config for: %s", tracking_key)
         
         return result
         
     except Exception as e:
-        frappe.logger().error(f"[get_org_config] Error: {str(e)}")
+        frappe.logger().error("[get_org_config] Error: %s", e)
         frappe.logger().error(frappe.get_traceback())
         return {"success": False, "message": str(e)}
 
@@ -244,19 +266,79 @@ def normalize_utm_value(raw_value, field_type="source"):
     return value
 
 
+# (terms, source) in priority order; a utm_source containing any term maps to source
+UTM_SOURCE_RULES = (
+    (("facebook", "fb", "instagram", "ig"), "Facebook"),
+    (("google", "google_ads", "adwords"), "Campaign"),
+    (("linkedin", "li"), "Advertisement"),
+    (("email", "newsletter"), "Mass Mailing"),
+    (("campaign", "promo", "offer", "ad", "paid"), "Campaign"),
+)
+
+
+def _utm_source_rule(utm_source):
+    """First rule (in UTM_SOURCE_RULES order) with a term contained in utm_source."""
+    return next(
+        (source for terms, source in UTM_SOURCE_RULES
+         if any(term in utm_source for term in terms)),
+        None
+    )
+
+
+# Exact-value fast path, computed with the ordered scan itself so it can
+# never disagree with it (e.g. "campaign" contains "ig" -> Facebook)
+UTM_SOURCE_INDEX = {term: _utm_source_rule(term) for terms, _ in UTM_SOURCE_RULES for term in terms}
+
+PAID_MEDIA = frozenset({"cpc", "ppc", "paid", "display", "paid_social"})
+
+# Referrer values the tracker sends when there is no real referrer
+NO_REFERRER_VALUES = frozenset({"direct", "", "null", "undefined"})
+
+# (domain fragments, source) in priority order; a referrer host containing
+# any fragment maps to source
+REFERRER_SOURCE_RULES = (
+    (("facebook.com", "fb.com", "instagram.com"), "Facebook"),
+    (("google.com", "googleads"), "Campaign"),
+)
+# Exact-host fast path; only hosts that can't contain another rule's fragment
+REFERRER_SOURCE_INDEX = {
+    "facebook.com": "Facebook",
+    "fb.com": "Facebook",
+    "instagram.com": "Facebook",
+    "google.com": "Campaign",
+}
+
+
+def _referrer_source(domain):
+    """
+    Exact host lookup first, then the substring rules in priority order,
+    so www.googleadservices.com, google.com.au, l.facebook.com etc. keep
+    matching the way they always have.
+    """
+    source = REFERRER_SOURCE_INDEX.get(domain)
+    if source:
+        return source
+    return next(
+        (source for fragments, source in REFERRER_SOURCE_RULES
+         if any(fragment in domain for fragment in fragments)),
+        None
+    )
+
+
 def determine_source(data, org_config):
     """
     Smart Source Detection - Checks ad click IDs FIRST
     """
-    frappe.logger().info("=" * 60)
-    frappe.logger().info("DETERMINING SOURCE")
-    frappe.logger().info("=" * 60)
+    if frappe.conf.get("track_verbose"):
+        frappe.logger().debug("=" * 60)
+        frappe.logger().debug("DETERMINING SOURCE")
+        frappe.logger().debug("=" * 60)
 
     #  1. Check for Ad Click IDs 
     ad_data = get_ad_click_data(data)
     if ad_data['ad_platform']:
         platform = ad_data['ad_platform']
-        frappe.logger().info(f" Ad Click Detected: {platform}")
+        frappe.logger().info(" Ad Click Detected: %s", platform)
         
         if platform == "Facebook/Instagram":
             frappe.logger().info(" Source: Facebook (from ad click ID)")
@@ -272,37 +354,24 @@ def determine_source(data, org_config):
             return "Campaign"
 
     # Check UTM Source
-    utm_source = str(data.get("utm_source") or "").lower().strip()
+    utm_source = _norm(data, "utm_source")
     if utm_source:
-        frappe.logger().info(f"🎯 Found UTM Source: '{utm_source}'")
-        
-        if any(fb_term in utm_source for fb_term in ['facebook', 'fb', 'instagram', 'ig']):
-            frappe.logger().info(" Source: Facebook (from UTM)")
-            return "Facebook"
-        
-        if any(google_term in utm_source for google_term in ['google', 'google_ads', 'adwords']):
-            frappe.logger().info(" Source: Campaign (from UTM - Google)")
-            return "Campaign"
-        
-        if any(li_term in utm_source for li_term in ['linkedin', 'li']):
-            frappe.logger().info(" Source: Advertisement (from UTM - LinkedIn)")
-            return "Advertisement"
-        
-        if any(email_term in utm_source for email_term in ['email', 'newsletter']):
-            frappe.logger().info(" Source: Mass Mailing (from UTM)")
-            return "Mass Mailing"
-        
-        if 'campaign' in utm_source or any(term in utm_source for term in ['promo', 'offer', 'ad', 'paid']):
-            frappe.logger().info(" Source: Campaign (from UTM keyword)")
-            return "Campaign"
+        frappe.logger().info("🎯 Found UTM Source: '%s'", utm_source)
+
+        # First rule wins, as a substring scan in UTM_SOURCE_RULES order;
+        # exact values skip the scan
+        source = UTM_SOURCE_INDEX.get(utm_source) or _utm_source_rule(utm_source)
+        if source:
+            frappe.logger().info(" Source: %s (from UTM)", source)
+            return source
 
     # Check UTM Medium
-    utm_medium = str(data.get("utm_medium") or "").lower().strip()
+    utm_medium = _norm(data, "utm_medium")
     if utm_medium:
-        if utm_medium in ['cpc', 'ppc', 'paid', 'display', 'paid_social']:
+        if utm_medium in PAID_MEDIA:
             frappe.logger().info(" Source: Campaign (from UTM Medium)")
             return "Campaign"
-        if utm_medium in ['social']:
+        if utm_medium == 'social':
             if utm_source and 'facebook' in utm_source:
                 return "Facebook"
             frappe.logger().info(" Source: Advertisement (from UTM Medium)")
@@ -312,30 +381,27 @@ def determine_source(data, org_config):
             return "Mass Mailing"
 
     # Check Referrer
-    referrer = str(data.get("referrer") or data.get("page_referrer") or "").lower().strip()
-    if referrer and referrer not in ['direct', '', 'null', 'undefined']:
+    # Not lowered: _host() lowercases just the host, not the whole URL.
+    # Only short values can be one of the placeholders.
+    referrer = _pick(data, "referrer").strip()
+    if referrer and (len(referrer) > 9 or referrer.lower() not in NO_REFERRER_VALUES):
         try:
-            parsed = urlparse(referrer)
-            domain = parsed.netloc.lower()
-            
-            if any(fb_domain in domain for fb_domain in ['facebook.com', 'fb.com', 'instagram.com']):
-                frappe.logger().info("✅ Source: Facebook (from Referrer)")
-                return "Facebook"
-            
-            if any(google_domain in domain for google_domain in ['google.com', 'googleads']):
-                frappe.logger().info("✅ Source: Campaign (from Referrer)")
-                return "Campaign"
-            
+            domain = _host(referrer).split(":", 1)[0]
+
+            source = _referrer_source(domain)
+            if source:
+                frappe.logger().info("✅ Source: %s (from Referrer)", source)
+                return source
+
             org_domains = org_config.get("domains", [])
             is_external = not any(org_domain in domain for org_domain in org_domains)
             if is_external and domain:
-                frappe.logger().info(f"✅ Source: Supplier Reference (from Referrer: {domain})")
+                frappe.logger().info("✅ Source: Supplier Reference (from Referrer: %s)", domain)
                 return "Supplier Reference"
         except Exception as e:
-            frappe.logger().error(f"Error parsing referrer: {str(e)}")
+            frappe.logger().error("Error parsing referrer: %s", e)
 
     frappe.logger().info("Source: Direct (default)")
-    frappe.logger().info("=" * 60)
     return "Direct"
 
 def enrich_lead_tracking_fields(lead_doc, data, utm_params, normalized_source, normalized_medium, source, client_id, org_config=None):
@@ -352,34 +418,29 @@ def enrich_lead_tracking_fields(lead_doc, data, utm_params, normalized_source, n
     - source: set only if currently empty
     - organization: backfill if missing
     """
-    from campaign_management.clients.base import (
-        get_ad_click_data,
-        enrich_lead_with_facebook_data
-    )
-
     # Always link ga_client_id if the lead doesn't have one
     if client_id and not lead_doc.get("ga_client_id"):
         lead_doc.ga_client_id = client_id
-        frappe.logger().info(f"[Enrich] Set ga_client_id: {client_id}")
+        frappe.logger().info("[Enrich] Set ga_client_id: %s", client_id)
         
     if org_config and not lead_doc.get("tracking_organization"):
         tracking_org_name = org_config.get("tracking_org")   # set by identify_organization()
         if tracking_org_name:
             lead_doc.tracking_organization = tracking_org_name
-            frappe.logger().info(f"[Enrich] Set tracking_organization: {tracking_org_name}")
+            frappe.logger().info("[Enrich] Set tracking_organization: %s", tracking_org_name)
 
     # UTM fields — first touch wins, never overwrite
     if normalized_source and not lead_doc.get("utm_source"):
         lead_doc.utm_source = normalized_source
-        frappe.logger().info(f"[Enrich] Set utm_source: {normalized_source}")
+        frappe.logger().info("[Enrich] Set utm_source: %s", normalized_source)
 
     if normalized_medium and not lead_doc.get("utm_medium"):
         lead_doc.utm_medium = normalized_medium
-        frappe.logger().info(f"[Enrich] Set utm_medium: {normalized_medium}")
+        frappe.logger().info("[Enrich] Set utm_medium: %s", normalized_medium)
 
     if utm_params.get("utm_campaign") and not lead_doc.get("utm_campaign"):
         lead_doc.utm_campaign = utm_params.get("utm_campaign")
-        frappe.logger().info(f"[Enrich] Set utm_campaign: {utm_params.get('utm_campaign')}")
+        frappe.logger().info("[Enrich] Set utm_campaign: %s", utm_params.get('utm_campaign'))
 
     if utm_params.get("utm_campaign_id") and not lead_doc.get("utm_campaign_id"):
         lead_doc.utm_campaign_id = utm_params.get("utm_campaign_id")
@@ -393,23 +454,23 @@ def enrich_lead_tracking_fields(lead_doc, data, utm_params, normalized_source, n
     
     if source and not lead_doc.get("source"):
         lead_doc.source = source
-        frappe.logger().info(f"[Enrich] Set source: {source}")
+        frappe.logger().info("[Enrich] Set source: %s", source)
 
     
     ad_data = get_ad_click_data(data)
     if ad_data.get("ad_platform"):
         if not lead_doc.get("ad_platform"):
             lead_doc.ad_platform = ad_data["ad_platform"]
-            frappe.logger().info(f"[Enrich] Set ad_platform: {ad_data['ad_platform']}")
+            frappe.logger().info("[Enrich] Set ad_platform: %s", ad_data['ad_platform'])
         if not lead_doc.get("ad_click_id"):
             
             full_click_id = ad_data["ad_click_id"] or ""
             lead_doc.ad_click_id = full_click_id[:140] if full_click_id else None
-            frappe.logger().info(f"[Enrich] Set ad_click_id (truncated): {lead_doc.ad_click_id}")
+            frappe.logger().info("[Enrich] Set ad_click_id (truncated): %s", lead_doc.ad_click_id)
         if not lead_doc.get("ad_click_id_full"):
            
             lead_doc.ad_click_id_full = ad_data["ad_click_id"]
-            frappe.logger().info(f"[Enrich] Set ad_click_id_full: {ad_data['ad_click_id']}")
+            frappe.logger().info("[Enrich] Set ad_click_id_full: %s", ad_data['ad_click_id'])
         if not lead_doc.get("ad_click_timestamp"):
             lead_doc.ad_click_timestamp = ad_data["ad_click_timestamp"]
         if not lead_doc.get("ad_landing_page"):
@@ -417,7 +478,7 @@ def enrich_lead_tracking_fields(lead_doc, data, utm_params, normalized_source, n
             landing = ad_data["ad_landing_page"] or ""
             lead_doc.ad_landing_page = landing[:140] if landing else None
     else:
-        frappe.logger().info(f"[Enrich] No ad click data in this request")
+        frappe.logger().info("[Enrich] No ad click data in this request")
 
     # Facebook-specific enrichment (fbclid written to Facebook-specific fields, source label etc.)
     # enrich_lead_with_facebook_data already checks internally before overwriting
@@ -426,6 +487,25 @@ def enrich_lead_tracking_fields(lead_doc, data, utm_params, normalized_source, n
     return lead_doc
 
 
+LEAD_UPDATE_FIELDS = (
+    "mobile_no", "lead_company", "territory", "gender", "source",
+    "ga_client_id", "tracking_organization",
+    "utm_source", "utm_medium", "utm_campaign", "utm_campaign_id", "utm_term", "utm_content",
+    "ad_platform", "ad_click_id", "ad_click_id_full", "ad_click_timestamp", "ad_landing_page",
+)
+
+
+def get_lead_update_fields():
+    """
+    Fields of LEAD_UPDATE_FIELDS that exist on CRM Lead on this site
+    (custom fields may not all be installed). These are the only fields
+    the existing-lead branch of submit_form and enrich_lead_tracking_fields
+    ever set.
+    """
+    meta = frappe.get_meta("CRM Lead")
+    return [f for f in LEAD_UPDATE_FIELDS if meta.has_field(f)]
+
+
 def find_lead_cross_device(email, client_id, org_name):
     """
     Lead lookup — email is the ONLY uniqueness key.
@@ -436,41 +516,40 @@ def find_lead_cross_device(email, client_id, org_name):
         return None
 
     try:
-        # Check same org first
-        existing = frappe.db.get_value(
-            "CRM Lead",
-            {"email": email, "organization": org_name},
-            ["name", "email", "mobile_no", "ga_client_id"],
-            as_dict=True
-        )
-        # Fallback: any org
-        if not existing:
-            existing = frappe.db.get_value(
-                "CRM Lead",
-                {"email": email},
-                ["name", "email", "mobile_no", "ga_client_id"],
-                as_dict=True
-            )
+        # Same-org match first, any org as fallback — one query
+        rows = frappe.db.sql("""
+            SELECT name, email, mobile_no, ga_client_id, organization
+            FROM `tabCRM Lead`
+            WHERE email = %s
+            ORDER BY (organization = %s) DESC, creation DESC
+            LIMIT 1
+        """, (email, org_name), as_dict=True)
+        existing = rows[0] if rows else None
 
         if existing:
-            frappe.logger().info(f"[find_lead] Found by email: {existing.name}")
+            frappe.logger().info("[find_lead] Found by email: %s", existing.name)
 
+            backfill = {}
             # Backfill org if missing
-            if not frappe.db.get_value("CRM Lead", existing.name, "organization"):
-                frappe.db.set_value("CRM Lead", existing.name,
-                                    "organization", org_name, update_modified=False)
-
+            if not existing.get("organization"):
+                backfill["organization"] = org_name
             # Backfill client_id if lead has none (cross-device arrival)
             if client_id and not existing.get("ga_client_id"):
-                frappe.db.set_value("CRM Lead", existing.name,
-                                    "ga_client_id", client_id, update_modified=False)
+                backfill["ga_client_id"] = client_id
+
+            if backfill:
+                frappe.db.set_value("CRM Lead", existing.name, backfill, update_modified=False)
+                existing.update(backfill)
+
+            if "ga_client_id" in backfill:
+                clear_leads_for_client(client_id)
                 link_web_visitor_to_lead(client_id, existing.name)
-                frappe.logger().info(f"[find_lead] Backfilled ga_client_id={client_id}")
+                frappe.logger().info("[find_lead] Backfilled ga_client_id=%s", client_id)
 
             return existing
 
     except Exception as e:
-        frappe.logger().error(f"[find_lead] Error: {str(e)}")
+        frappe.logger().error("[find_lead] Error: %s", e)
 
     return None
 
@@ -489,7 +568,7 @@ def get_or_create_lead_upsert(lead_data, email, client_id, org_name):
     existing = find_lead_cross_device(email, client_id, org_name)
 
     if existing:
-        frappe.logger().info(f"[UPSERT] Existing lead found: {existing['name']}")
+        frappe.logger().info("[UPSERT] Existing lead found: %s", existing['name'])
         return frappe.get_doc("CRM Lead", existing["name"]), False
 
     # 2️ Create new lead
@@ -499,7 +578,6 @@ def get_or_create_lead_upsert(lead_data, email, client_id, org_name):
 
     try:
         lead.insert(ignore_permissions=True)
-        frappe.db.commit()
         return lead, True
 
     except Exception as e:
@@ -515,6 +593,20 @@ def get_or_create_lead_upsert(lead_data, email, client_id, org_name):
 
 
 
+# Common country code to name mapping (add more as needed)
+COUNTRY_TERRITORY_MAP = {
+    "US": "United States",
+    "USA": "United States",
+    "UK": "United Kingdom",
+    "GB": "United Kingdom",
+    "IN": "India",
+    "IND": "India",
+    "CA": "Canada",
+    "AU": "Australia",
+    "AUS": "Australia",
+}
+
+
 def normalize_country_to_territory(country_value):
     """
     Convert country data to territory format.
@@ -524,45 +616,185 @@ def normalize_country_to_territory(country_value):
     if not country_value:
         return None
     
-    # Common country code to name mapping (add more as needed)
-    country_map = {
-        "US": "United States",
-        "USA": "United States",
-        "UK": "United Kingdom",
-        "GB": "United Kingdom",
-        "IN": "India",
-        "IND": "India",
-        "CA": "Canada",
-        "AU": "Australia",
-        "AUS": "Australia",
-    }
-    
     value = str(country_value).strip()
-    value_upper = value.upper()
-    
-    if value_upper in country_map:
-        return country_map[value_upper]
-    
-    return value
+    return COUNTRY_TERRITORY_MAP.get(value.upper(), value)
 
 
+def _first(d, *keys, default=""):
+    """First truthy value among keys in d, as a string."""
+    return next((str(d[k]) for k in keys if d.get(k)), default)
+
+
+# Canonical payload field -> the keys clients send it under, first match wins
+PAYLOAD_ALIASES = {
+    "client_id": ("ga_client_id", "client_id"),
+    "referrer": ("referrer", "page_referrer"),
+    "activity_type": ("activity_type", "event"),
+    "tracking_key": ("tracking_key", "org_key"),
+    "page_url_full": ("page_url_full", "page_url", "page_location"),
+    "page_url": ("page_url", "page_location"),
+    "email": ("lead_email", "email"),
+    "phone": ("mobileNo", "phone", "mobile_no", "mobile", "phoneNumber"),
+    "first_name": ("firstName", "first_name", "First Name"),
+    "last_name": ("lastName", "last_name", "Last Name"),
+    "company": ("company", "lead_company"),
+    "country": ("country", "territory", "country_code"),
+    "message": ("message", "comments"),
+    "tracked_item": ("product_name", "feature_name", "service_name"),
+    "cta_name": ("cta_name", "link_name"),
+    "form_name": ("form_name", "form_id"),
+    "fbclid": ("fbclid", "ad_click_id_value"),
+}
+
+
+def _pick(d, field):
+    """Value of a canonical field (see PAYLOAD_ALIASES), as a string."""
+    return _first(d, *PAYLOAD_ALIASES[field])
 
-def get_request_data():
-    """Safely extract data from various request formats"""
-    data = {}
-    try:
-        if frappe.local.form_dict:
-            data.update(frappe.local.form_dict)
-        if hasattr(frappe.local, 'request') and hasattr(frappe.local.request, 'form'):
-            form_data = dict(frappe.local.request.form)
-            data.update(form_data)
-        if hasattr(frappe.local, 'request') and frappe.local.request.data:
-            json_body = frappe.local.request.get_json(silent=True)
-            if json_body:
-                data.update(json_body)
-    except Exception as e:
-        frappe.logger().error(f"Error reading request data: {str(e)}")
-    return data
+
+def _norm(d, *keys):
+    """_first, stripped and lowercased in one pass over the keys."""
+    for k in keys:
+        v = d.get(k)
+        if v:
+            return str(v).strip().lower()
+    return ""
+
+
+_HOST_RE = re.compile(r"^[a-zA-Z][a-zA-Z0-9+.-]*://([^/?#]+)")
+
+
+def _host(url):
+    """Lowercased host[:port] of a URL; schemeless input is treated as host/path."""
+    m = _HOST_RE.match(url)
+    return (m.group(1) if m else url.split('/', 1)[0]).lower()
+
+
+def _config_epoch():
+    """
+    (site, config version) key for the per-process organization memos.
+    The version lives in Redis next to the config and changes whenever the
+    config is reloaded or cleared, so every worker drops its memos at once;
+    the site keeps one site's answers from leaking into another's on a
+    multi-site bench.
+    """
+    get_organization_config_cached()
+    return frappe.local.site, frappe.cache().get_value(ORG_CONFIG_VERSION_KEY)
+
+
+def _compile_org_matcher(pattern_to_key):
+    """
+    One compiled alternation over all patterns with a named group per org
+    (o0, o1, ...), so a single left-to-right search finds the first
+    pattern of any org in the text. Longer patterns are tried first at
+    each position. Returns (regex, keys) where keys[i] is the tracking_key
+    of group oi, or (None, []) when there are no patterns.
+    """
+    patterns_by_key = {}
+    for pattern, key in pattern_to_key.items():
+        patterns_by_key.setdefault(key, []).append(pattern)
+
+    keys = list(patterns_by_key)
+    if not keys:
+        return None, keys
+
+    regex = re.compile("|".join(
+        f"(?P<o{i}>{'|'.join(re.escape(p) for p in sorted(patterns, key=len, reverse=True))})"
+        for i, patterns in enumerate(patterns_by_key.values())
+    ))
+    return regex, keys
+
+
+def _match_org(regex, keys, text):
+    """tracking_key of the first org pattern found in text, or None."""
+    match = regex.search(text) if regex else None
+    return keys[int(match.lastgroup[1:])] if match else None
+
+
+def _suffix_lookup(index, host):
+    """Value for the longest dot-suffix of host present in index (at least two labels), or None."""
+    parts = host.split(".")
+    for i in range(max(len(parts) - 1, 1)):
+        key = index.get(".".join(parts[i:]))
+        if key:
+            return key
+    return None
+
+
+# One index per (site, config version) still in use; room for every site
+# on a bench without evicting each other's
+ORG_INDEX_CACHE_SIZE = 32
+
+
+@functools.lru_cache(maxsize=ORG_INDEX_CACHE_SIZE)
+def _get_organization_index(config_epoch):
+    """
+    Flatten the organization config into lookup structures, built once per
+    config_epoch (see _config_epoch: site + config version) instead of
+    re-walking every org on every request. Must be called with the epoch
+    of the current site, whose get_organization_config_cached() it reads.
+
+    Returns (domain_to_key, domain_re, domain_keys, keyword_re, keyword_keys):
+    - domain_to_key: configured domain -> tracking_key
+    - domain_re / domain_keys: _compile_org_matcher over the domains
+    - keyword_re / keyword_keys: _compile_org_matcher over the keywords
+    First configured org wins when two orgs share a domain or keyword.
+    """
+    ORGANIZATION_CONFIG = get_organization_config_cached() or {}
+
+    domain_to_key = {}
+    keyword_to_key = {}
+    for key, config in ORGANIZATION_CONFIG.items():
+        for org_domain in config.get("domains") or []:
+            if org_domain:
+                domain_to_key.setdefault(org_domain, key)
+        for keyword in config.get("keywords") or []:
+            if keyword:
+                keyword_to_key.setdefault(keyword, key)
+
+    domain_re, domain_keys = _compile_org_matcher(domain_to_key)
+    keyword_re, keyword_keys = _compile_org_matcher(keyword_to_key)
+    return domain_to_key, domain_re, domain_keys, keyword_re, keyword_keys
+
+
+@functools.lru_cache(maxsize=512)
+def _identify_cached(page_host, referrer_host, site_domain, config_epoch):
+    """
+    Resolve a tracking_key from already-parsed request hosts.
+
+    Pure function of its arguments, so results are memoised per process.
+    config_epoch (site, config version) is part of the key so a cached
+    answer never outlives the organization config it was computed from,
+    and never crosses sites.
+    Hosts are None when the corresponding field was not sent.
+    Returns None when nothing matches.
+    """
+    domain_to_key, domain_re, domain_keys, _, _ = _get_organization_index(config_epoch)
+
+    # 2. page_url domain, 3. referrer domain, 4. site_domain
+    # (1, the explicit tracking_key, is checked by identify_organization)
+    hosts = [host for host in (page_host, referrer_host, site_domain) if host is not None]
+
+    # Exact host, then its parent domains (shop.example.com -> example.com):
+    # a few dict hits per host, longest match first
+    for host in hosts:
+        key = _suffix_lookup(domain_to_key, host)
+        if key:
+            return key
+
+    # Configured domain contained in a host: one scan over all hosts, in
+    # priority order, so the leftmost hit comes from the best host
+    key = _match_org(domain_re, domain_keys, "\n".join(hosts))
+    if key:
+        return key
+
+    # Host that is a fragment of a configured domain (e.g. bare "example")
+    for host in hosts:
+        for org_domain, key in domain_to_key.items():
+            if host and host in org_domain:
+                return key
+
+    return None
 
 
 def identify_organization(data):
@@ -570,9 +802,10 @@ def identify_organization(data):
     Dynamic Organization Detection using Tracking Organization doctype
     
     """
-    frappe.logger().info("=" * 60)
-    frappe.logger().info("IDENTIFYING ORGANIZATION")
-    frappe.logger().info("=" * 60)
+    if frappe.conf.get("track_verbose"):
+        frappe.logger().debug("=" * 60)
+        frappe.logger().debug("IDENTIFYING ORGANIZATION")
+        frappe.logger().debug("=" * 60)
     
     # Get dynamic config from database 
     ORGANIZATION_CONFIG = get_organization_config_cached()
@@ -582,129 +815,137 @@ def identify_organization(data):
         frappe.logger().error("Please create at least one Tracking Organization in the system")
         raise ValueError("No tracking organizations configured. Please contact administrator.")
     
-    frappe.logger().info(f"Available organizations: {list(ORGANIZATION_CONFIG.keys())}")
-    
-    # 1. Check explicit tracking_key parameter 
-    tracking_key = str(data.get("tracking_key") or data.get("org_key") or "").lower().strip()
+    # 1. Explicit tracking_key: checked against the live config, never memoised
+    tracking_key = _pick(data, "tracking_key").lower().strip()
     if tracking_key:
-        frappe.logger().info(f"🔑 Checking explicit tracking_key: '{tracking_key}'")
         if tracking_key in ORGANIZATION_CONFIG:
-            frappe.logger().info(f" Org identified via tracking_key: {tracking_key}")
+            frappe.logger().info("Org identified: %s", tracking_key)
             return ORGANIZATION_CONFIG[tracking_key]
-        else:
-            frappe.logger().warning(f" tracking_key '{tracking_key}' not found in config")
-            frappe.logger().error(f"Available keys: {list(ORGANIZATION_CONFIG.keys())}")
-            raise ValueError(f"Unknown tracking_key: {tracking_key}")
-    
-    
-    page_url = str(data.get("page_url_full") or data.get("page_url") or data.get("page_location") or "")
-    if page_url:
-        
-        display_url = page_url[:100] + "..." if len(page_url) > 100 else page_url
-        frappe.logger().info(f"Checking page_url: {display_url}")
-        
-        try:
-            parsed = urlparse(page_url)
-            domain = parsed.netloc.lower()
-            
-            for key, config in ORGANIZATION_CONFIG.items():
-                for org_domain in config["domains"]:
-                    if org_domain in domain or domain in org_domain:
-                        frappe.logger().info(f"Org identified via domain: {key}")
-                        return config
-        except Exception as e:
-            frappe.logger().error(f"Error parsing page_url: {str(e)}")
-            # Fallback: simple string matching
-            page_url_lower = page_url.lower()
-            for key, config in ORGANIZATION_CONFIG.items():
-                for org_domain in config["domains"]:
-                    if org_domain in page_url_lower:
-                        frappe.logger().info(f"Org identified via fallback: {key}")
-                        return config
-
-    # 3. Check referrer domain
-    referrer = str(data.get("referrer") or data.get("page_referrer") or "").lower()
-    if referrer and referrer not in ['direct', '', 'null', 'undefined']:
-        frappe.logger().info(f" Checking referrer: {referrer}")
-        try:
-            parsed = urlparse(referrer)
-            domain = parsed.netloc.lower()
-            frappe.logger().info(f"   Extracted domain: {domain}")
-            
-            for key, config in ORGANIZATION_CONFIG.items():
-                for org_domain in config["domains"]:
-                    if org_domain in domain or domain in org_domain:
-                        frappe.logger().info(f" Org identified via referrer domain: {key} (matched: {org_domain})")
-                        return config
-        except Exception as e:
-            frappe.logger().error(f"Error parsing referrer: {str(e)}")
-    
-    # 4. Check site_domain parameter
+        frappe.logger().warning(" tracking_key '%s' not found in config", tracking_key)
+        frappe.logger().error("Available keys: %s", list(ORGANIZATION_CONFIG.keys()))
+        raise ValueError(f"Unknown tracking_key: {tracking_key}")
+
+    page_url = _pick(data, "page_url_full")
+    referrer = _pick(data, "referrer").lower()
     site_domain = str(data.get("site_domain") or "").lower()
-    if site_domain:
-        frappe.logger().info(f" Checking site_domain: {site_domain}")
-        for key, config in ORGANIZATION_CONFIG.items():
-            for org_domain in config["domains"]:
-                if org_domain in site_domain or site_domain in org_domain:
-                    frappe.logger().info(f" Org identified via site_domain: {key} (matched: {org_domain})")
-                    return config
+
+    # Extract each host once; only the hosts go into the memoised lookup
+    page_host = _host(page_url) if page_url else None
+    referrer_host = None
+    if referrer and referrer not in NO_REFERRER_VALUES:
+        referrer_host = _host(referrer)
+
+    org_key = _identify_cached(
+        page_host,
+        referrer_host,
+        site_domain or None,
+        _config_epoch()
+    )
+
+    if org_key in ORGANIZATION_CONFIG:
+        frappe.logger().info("Org identified: %s", org_key)
+        return ORGANIZATION_CONFIG[org_key]
     
     # 5. Fallback: keyword matching
     search_text = f"{page_url} {referrer} {site_domain}".lower()
-    frappe.logger().info(f" Attempting keyword matching in: {search_text[:100]}...")
+    frappe.logger().info(" Attempting keyword matching in: %s...", search_text[:100])
     
-    for key, config in ORGANIZATION_CONFIG.items():
-        keywords = config.get("keywords", [])
-        if keywords:
-            for keyword in keywords:
-                if keyword and keyword in search_text:
-                    frappe.logger().info(f" Org identified via keyword match: {key} (keyword: {keyword})")
-                    return config
+    # One regex pass over the text instead of a substring test per keyword
+    _, _, _, keyword_re, keyword_keys = _get_organization_index(_config_epoch())
+    key = _match_org(keyword_re, keyword_keys, search_text)
+    if key in ORGANIZATION_CONFIG:
+        frappe.logger().info(" Org identified via keyword match: %s", key)
+        return ORGANIZATION_CONFIG[key]
     
     
     if len(ORGANIZATION_CONFIG) == 1:
         default_key = list(ORGANIZATION_CONFIG.keys())[0]
         default_org = ORGANIZATION_CONFIG[default_key]
-        frappe.logger().info(f"Only one organization exists, defaulting to: {default_key}")
-        frappe.logger().info(f"   Organization: {default_org['org_name']}")
+        frappe.logger().info("Only one organization exists, defaulting to: %s", default_key)
+        frappe.logger().info("   Organization: %s", default_org['org_name'])
         return default_org
     
     # Could not identify
     frappe.logger().error(" Could not identify organization from request data!")
-    frappe.logger().error(f"   Available organizations: {list(ORGANIZATION_CONFIG.keys())}")
-    frappe.logger().error(f"   page_url: {page_url}")
-    frappe.logger().error(f"   referrer: {referrer}")
-    frappe.logger().error(f"   site_domain: {site_domain}")
-    frappe.logger().error(f"   tracking_key: {tracking_key}")
+    frappe.logger().error("   Available organizations: %s", list(ORGANIZATION_CONFIG.keys()))
+    frappe.logger().error("   page_url: %s", page_url)
+    frappe.logger().error("   referrer: %s", referrer)
+    frappe.logger().error("   site_domain: %s", site_domain)
+    frappe.logger().error("   tracking_key: %s", tracking_key)
     
     raise ValueError(
         f"Could not identify organization. Available: {', '.join(ORGANIZATION_CONFIG.keys())}. "
         f"Please provide tracking_key or ensure domain matches one of the configured domains."
     )
 
+def identify_organization_for_client(data):
+    """
+    identify_organization with a per-visitor shortcut.
+
+    An explicit tracking_key is the fast path and always wins (one dict
+    lookup). Otherwise the org this client_id resolved to on the same host
+    is reused for an hour, so repeat events from the same visitor skip
+    detection. The host is part of the key: a client_id cookie shared
+    across two orgs' domains must not pin the visitor to the first one.
+    """
+    client_id = _pick(data, "client_id")
+    has_explicit_key = bool(_pick(data, "tracking_key"))
+    page_url = _pick(data, "page_url_full")
+    host = (_host(page_url) if page_url else None) or str(data.get("site_domain") or "").lower()
+    cache_key = f"org_of:{client_id}:{host}"
+
+    if client_id and not has_explicit_key:
+        cached_key = frappe.cache().get_value(cache_key)
+        if cached_key:
+            ORGANIZATION_CONFIG = get_organization_config_cached() or {}
+            if cached_key in ORGANIZATION_CONFIG:
+                return ORGANIZATION_CONFIG[cached_key]
+
+    org_config = identify_organization(data)
+
+    if client_id and org_config.get("tracking_key"):
+        frappe.cache().set_value(cache_key, org_config["tracking_key"], expires_in_sec=3600)
+
+    return org_config
+
+
+def _remember_org(org_name):
+    """Record a verified org in the site's Redis set (shared across workers)."""
+    frappe.cache().sadd("known_orgs", org_name)
+
+
 def verify_organization_exists(org_name, org_config=None):
     """
     FIXED: Verify if organization exists in CRM.
     Handles both direct CRM Organization names and Tracking Organization links.
-    
+    Positive results are cached in the site-scoped Redis set "known_orgs",
+    so an org is only looked up in the DB once per site.
     """
     try:
-        frappe.logger().info(f"🔍 Verifying organization: '{org_name}'")
+        if frappe.cache().sismember("known_orgs", org_name):
+            return True
+    except Exception as e:
+        frappe.logger().warning("known_orgs cache unavailable: %s", e)
+
+    try:
+        frappe.logger().info("🔍 Verifying organization: '%s'", org_name)
         
         
         if org_config and org_config.get("crm_organization"):
             crm_org_name = org_config["crm_organization"]
-            frappe.logger().info(f"🔗 Using CRM Organization from config: '{crm_org_name}'")
+            frappe.logger().info("🔗 Using CRM Organization from config: '%s'", crm_org_name)
             
             if frappe.db.exists("CRM Organization", crm_org_name):
-                frappe.logger().info(f"✅ CRM Organization '{crm_org_name}' exists")
+                frappe.logger().info("✅ CRM Organization '%s' exists", crm_org_name)
+                _remember_org(org_name)
                 return True
             else:
-                frappe.logger().error(f"❌ CRM Organization '{crm_org_name}' not found in database")
+                frappe.logger().error("❌ CRM Organization '%s' not found in database", crm_org_name)
         
         
         if frappe.db.exists("CRM Organization", org_name):
-            frappe.logger().info(f"✅ Found CRM Organization directly: '{org_name}'")
+            frappe.logger().info("✅ Found CRM Organization directly: '%s'", org_name)
+            _remember_org(org_name)
             return True
         
        
@@ -717,16 +958,17 @@ def verify_organization_exists(org_name, org_config=None):
         
         if tracking_org_data and tracking_org_data.get("crm_organization"):
             crm_org = tracking_org_data["crm_organization"]
-            frappe.logger().info(f" Found via Tracking Org (key: {tracking_org_data.get('tracking_key')}). CRM Org: '{crm_org}'")
+            frappe.logger().info(" Found via Tracking Org (key: %s). CRM Org: '%s'", tracking_org_data.get('tracking_key'), crm_org)
             
             if frappe.db.exists("CRM Organization", crm_org):
-                frappe.logger().info(f" CRM Organization '{crm_org}' exists")
+                frappe.logger().info(" CRM Organization '%s' exists", crm_org)
+                _remember_org(org_name)
                 return True
             else:
-                frappe.logger().error(f" Linked CRM Organization '{crm_org}' not found")
+                frappe.logger().error(" Linked CRM Organization '%s' not found", crm_org)
         
         
-        frappe.logger().error(f" Organization '{org_name}' not found in CRM")
+        frappe.logger().error(" Organization '%s' not found in CRM", org_name)
         
      
         all_crm_orgs = frappe.get_all("CRM Organization", pluck="name", limit=20)
@@ -737,8 +979,8 @@ def verify_organization_exists(org_name, org_config=None):
             limit=20
         )
         
-        frappe.logger().error(f"📋 Available CRM Organizations (first 20): {all_crm_orgs}")
-        frappe.logger().error(f"📋 Available Tracking Organizations (first 20): {json.dumps(all_tracking_orgs, indent=2)}")
+        frappe.logger().error("📋 Available CRM Organizations (first 20): %s", all_crm_orgs)
+        frappe.logger().error("📋 Available Tracking Organizations (first 20): %s", all_tracking_orgs)
         frappe.logger().error("💡 Fix options:")
         frappe.logger().error("   1. Create a CRM Organization with this exact name")
         frappe.logger().error("   2. OR link an existing CRM Organization in the Tracking Organization")
@@ -746,16 +988,29 @@ def verify_organization_exists(org_name, org_config=None):
         return False
         
     except Exception as e:
-        frappe.logger().error(f"❌ Error verifying organization: {str(e)}")
+        frappe.logger().error("❌ Error verifying organization: %s", e)
         frappe.logger().error(frappe.get_traceback())
         return False
 
 
 
+@frappe.whitelist(allow_guest=True, methods=['GET', 'POST'])
+def get_tracking_job_result(job_id):
+    """
+    Outcome of a queued submit_form / track_activity call, by the job_id
+    it returned: the job's own response (lead, is_new_lead, ...) once it
+    has run, or {"success": True, "queued": True} while it is pending.
+    """
+    result = frappe.cache().get_value(tracking_job_result_key(job_id))
+    return result if result is not None else {"success": True, "queued": True, "job_id": job_id}
+
+
 @frappe.whitelist(allow_guest=True, methods=['POST'])
 def submit_form(**kwargs):
     """
-    FIXED: Form submission with enhanced field mapping and debugging
+    Form submission endpoint.
+    Validates the required fields and the organization, then leaves the
+    lead writes to _process_form on a background job.
     """
     frappe.set_user("Guest")
     frappe.flags.ignore_csrf = True
@@ -764,77 +1019,81 @@ def submit_form(**kwargs):
         data = get_request_data()
         data.update(kwargs)
 
-        log_data = {**data}
-        if log_data.get('page_url') and len(str(log_data['page_url'])) > 100:
-            log_data['page_url'] = str(log_data['page_url'])[:100] + '...'
-        
-        frappe.logger().info("=" * 80)
-        frappe.logger().info("📥 FORM SUBMISSION RECEIVED")
-        frappe.logger().info("=" * 80)
-        frappe.logger().info(json.dumps(data, indent=2, default=str))
-        frappe.logger().info("=" * 80)
-
-        org_config = identify_organization(data)
+        org_config = identify_organization_for_client(data)
         org_name = org_config["org_name"]
-        org_type = org_config.get("org_type")
-
         if not verify_organization_exists(org_name):
             return {
                 "success": False,
                 "message": f"Organization '{org_name}' not found"
             }
 
-        from campaign_management.clients.base import (
-            extract_browser_details,
-            get_geo_info_from_ip,
-            link_web_visitor_to_lead,
-            add_activity_to_lead,
-            get_utm_params_from_data,
-            link_historical_activities_to_lead,
-            get_facebook_ad_data,
-            enrich_lead_with_facebook_data
-        )
+        first_name = _pick(data, "first_name").strip()
+        if not first_name:
+            return {"success": False, "message": "First name is required"}
+
+        has_email = _pick(data, "email").strip()
+        has_phone = _pick(data, "phone").strip()
+        if not has_email and not has_phone:
+            return {"success": False, "message": "Email or Phone is required"}
+
+        capture_request_context(data)
+        client_id = _pick(data, "client_id")
+        # The job reuses the org resolved here instead of identifying it again
+        result = enqueue_tracking_job(_process_form, data, client_id, "form", org_config=org_config)
+        if result.get("queued"):
+            result["organization"] = org_name
+        return result
 
-        first_name = str(
-            data.get("firstName") or
-            data.get("first_name") or
-            data.get("First Name") or ""
-        ).strip()
-
-        last_name = str(
-            data.get("lastName") or
-            data.get("last_name") or
-            data.get("Last Name") or ""
-        ).strip()
-
-        email = str(
-            data.get("lead_email") or
-            data.get("email") or ""
-        ).strip().lower()
-
-        phone = str(
-            data.get("mobileNo") or
-            data.get("phone") or 
-            data.get("mobile_no") or
-            data.get("mobile") or 
-            data.get("phoneNumber") or ""
-        ).strip()
+    except Exception as e:
+        frappe.logger().error(frappe.get_traceback())
+        return {"success": False, "message": str(e)}
+
+
+def _process_form(data, org_config=None):
+    """
+    Lead create/update for a submitted form (runs on the short queue).
+    Expects data to have been through capture_request_context, and the
+    org_config that submit_form already resolved and verified.
+    """
+    try:
+        # Full payload dump is opt-in: set track_verbose in site config
+        if frappe.conf.get("track_verbose"):
+            log_data = {**data}
+            if log_data.get('page_url') and len(str(log_data['page_url'])) > 100:
+                log_data['page_url'] = str(log_data['page_url'])[:100] + '...'
+
+            frappe.logger().debug("=" * 80)
+            frappe.logger().debug("📥 FORM SUBMISSION RECEIVED")
+            frappe.logger().debug("=" * 80)
+            frappe.logger().debug("Received data: %s", log_data)
+            frappe.logger().debug("=" * 80)
+
+        if org_config is None:
+            org_config = identify_organization_for_client(data)
+            if not verify_organization_exists(org_config["org_name"]):
+                return {
+                    "success": False,
+                    "message": f"Organization '{org_config['org_name']}' not found"
+                }
+        org_name = org_config["org_name"]
+        org_type = org_config.get("org_type")
+
+        first_name = _pick(data, "first_name").strip()
+
+        last_name = _pick(data, "last_name").strip()
+
+        email = _pick(data, "email").strip().lower()
+
+        phone = _pick(data, "phone").strip()
 
         gender = str(data.get("gender") or "").strip()
-        company = str(data.get("company") or data.get("lead_company") or "").strip()
-        country_raw = str(
-            data.get("country") or
-            data.get("territory") or
-            data.get("country_code") or ""
-        ).strip()
+        company = _pick(data, "company").strip()
+        country_raw = _pick(data, "country").strip()
         territory = normalize_country_to_territory(country_raw)
         #country = str(data.get("country") or "").strip()
-        message = str(data.get("message") or data.get("comments") or "").strip()
+        message = _pick(data, "message").strip()
 
-        client_id = str(
-            data.get("ga_client_id") or
-            data.get("client_id") or ""
-        )
+        client_id = _pick(data, "client_id")
 
         if not first_name:
             return {"success": False, "message": "First name is required"}
@@ -856,24 +1115,17 @@ def submit_form(**kwargs):
 
         fb_data = get_facebook_ad_data(data)
 
-        user_agent = str(
-            data.get("user_agent") or
-            frappe.get_request_header("User-Agent", "")
-        )
-
-        ip_address = str(
-            data.get("ip_address") or
-            frappe.local.request_ip or ""
-        )
+        user_agent = data.get("user_agent") or ""
+        ip_address = data.get("ip_address") or ""
 
-        page_url = str(data.get("page_url_full") or data.get("page_url") or data.get("page_location") or "")
-        referrer = str(data.get("referrer") or data.get("page_referrer") or "")
+        page_url = _pick(data, "page_url_full")
+        referrer = _pick(data, "referrer")
         
         existing_lead = None
         
         if email:
             recent_lead = frappe.db.sql("""
-                SELECT name, creation
+                SELECT name, email, mobile_no, ga_client_id
                 FROM `tabCRM Lead`  
                 WHERE email = %s
                 AND creation > DATE_SUB(NOW(), INTERVAL 30 SECOND)
@@ -882,16 +1134,11 @@ def submit_form(**kwargs):
             """, (email,), as_dict=1)
             
             if recent_lead:
-                frappe.logger().info(f"[Dedup] Race condition caught — lead exists, forcing enrichment path")
-                
-                existing_lead = frappe.db.get_value(
-                    "CRM Lead",
-                    recent_lead[0].name,
-                    ["name", "email", "mobile_no", "ga_client_id"],
-                    as_dict=True
-                )
+                frappe.logger().info("[Dedup] Race condition caught — lead exists, forcing enrichment path")
+                existing_lead = recent_lead[0]
 
         browser_details = extract_browser_details(user_agent)
+        browser_str = f"{browser_details['browser']} on {browser_details['os']}"
         geo_info = get_geo_info_from_ip(ip_address)
 
         geo_location = (
@@ -900,7 +1147,7 @@ def submit_form(**kwargs):
         )
 
         try:
-            parsed = urlparse(page_url)
+            parsed = parse_url(page_url)
            
             website_url = f"{parsed.scheme}://{parsed.netloc}{parsed.path}"
             website_url = website_url.rstrip('/')
@@ -912,10 +1159,10 @@ def submit_form(**kwargs):
                 if len(website_url) > 140:
                     website_url = website_url[:140]
             
-            frappe.logger().info(f"📍 Website URL: {website_url}")
+            frappe.logger().info("📍 Website URL: %s", website_url)
             
         except Exception as e:
-            frappe.logger().error(f"Error parsing page_url for website: {str(e)}")
+            frappe.logger().error("Error parsing page_url for website: %s", e)
             website_url = page_url.split("?")[0][:140]
 
         complete_tracking_data = {
@@ -935,27 +1182,48 @@ def submit_form(**kwargs):
             "referrer": referrer
         }
 
+        # Context shared by the Form Submission activity of either branch below
+        activity_ctx = {
+            "page_url": page_url,
+            "browser": browser_str,
+            "device": browser_details["device"],
+            "geo_location": geo_location,
+            "referrer": referrer,
+            "client_id": client_id,
+            "utm_source": normalized_source,
+            "utm_medium": normalized_medium,
+            "utm_campaign": utm_params.get("utm_campaign"),
+            "fbclid": _pick(data, "fbclid")
+        }
+
         if not existing_lead:
             existing_lead = find_lead_cross_device(email, client_id, org_name)
 
         if existing_lead:
-            lead = frappe.get_doc("CRM Lead", existing_lead["name"])
+            # Only a handful of first-touch fields can change here, so read
+            # just those and write back the difference instead of loading
+            # and saving the whole document.
+            lead_fields = get_lead_update_fields()
+            current = frappe.db.get_value(
+                "CRM Lead", existing_lead["name"], lead_fields, as_dict=True
+            ) or {}
+            lead = frappe._dict(current, name=existing_lead["name"])
 
             if phone and not lead.get("mobile_no"):
                 lead.mobile_no = phone
-                frappe.logger().info(f"Updated phone: {phone}")
+                frappe.logger().info("Updated phone: %s", phone)
 
             if company and not lead.get("lead_company"):
                 lead.lead_company = company
-                frappe.logger().info(f"Updated company: {company}")
+                frappe.logger().info("Updated company: %s", company)
 
             if territory and not lead.get("territory"):
                 lead.territory = territory
-                frappe.logger().info(f"Updated territory: {territory}")
+                frappe.logger().info("Updated territory: %s", territory)
 
             if gender and not lead.get("gender"):
                 lead.gender = gender
-                frappe.logger().info(f"Updated gender: {gender}")
+                frappe.logger().info("Updated gender: %s", gender)
 
             
             lead = enrich_lead_tracking_fields(
@@ -969,10 +1237,14 @@ def submit_form(**kwargs):
                 org_config=org_config
             )
 
-            lead.save(ignore_permissions=True)
+            updates = {f: lead.get(f) for f in lead_fields if lead.get(f) != current.get(f)}
+            if updates:
+                frappe.db.set_value("CRM Lead", lead.name, updates)
+                if "ga_client_id" in updates:
+                    clear_leads_for_client(client_id)
 
             if message:
-                lead.add_comment("Info", f"Form submission: {message}")
+                add_lead_comment(lead.name, f"Form submission: {message}")
 
             # Link visitor and migrate historical activities
             # (in case lead was created by another app and visitor was never linked)
@@ -981,18 +1253,9 @@ def submit_form(**kwargs):
                 link_historical_activities_to_lead(client_id, lead.name)
 
             add_activity_to_lead(lead.name, {
+                **activity_ctx,
                 "activity_type": "Form Submission",
-                "page_url": page_url,          
-                "timestamp": now(),
-                "browser": f"{browser_details['browser']} on {browser_details['os']}",
-                "device": browser_details["device"],
-                "geo_location": geo_location,
-                "referrer": referrer,
-                "client_id": client_id,
-                "utm_source": normalized_source,
-                "utm_medium": normalized_medium,
-                "utm_campaign": utm_params.get("utm_campaign"),
-                "fbclid": data.get("fbclid") or data.get("ad_click_id_value") or ""
+                "timestamp": now()
             })
 
             frappe.db.commit()
@@ -1034,7 +1297,7 @@ def submit_form(**kwargs):
             "utm_campaign": utm_params.get("utm_campaign"),
             "utm_campaign_id": utm_params.get("utm_campaign_id"),
             "full_tracking_details": json.dumps(
-                complete_tracking_data, indent=2, default=str
+                complete_tracking_data, separators=(",", ":"), default=str
             )
         }
 
@@ -1050,24 +1313,15 @@ def submit_form(**kwargs):
             org_config=org_config
         )
         lead.save(ignore_permissions=True)
-        frappe.db.commit()
 
         if client_id:
             link_web_visitor_to_lead(client_id, lead.name)
             link_historical_activities_to_lead(client_id, lead.name)
 
         add_activity_to_lead(lead.name, {
+            **activity_ctx,
             "activity_type": "First Form Submission" if is_new else "Form Submission",
-            "page_url_full": page_url,
-            "timestamp": now(),
-            "browser": f"{browser_details['browser']} on {browser_details['os']}",
-            "device": browser_details["device"],
-            "geo_location": geo_location,
-            "referrer": referrer,
-            "client_id": client_id,
-            "utm_source": normalized_source,
-            "utm_medium": normalized_medium,
-            "utm_campaign": utm_params.get("utm_campaign")
+            "timestamp": now()
         })
 
         frappe.db.commit()
@@ -1108,60 +1362,269 @@ def submit_form(**kwargs):
 
     except Exception as e:
         frappe.logger().error(frappe.get_traceback())
+        frappe.log_error(frappe.get_traceback(), "Form Submission Error")
         return {"success": False, "message": str(e)}
     
     
     
-def get_all_leads_for_client(client_id, visitor_converted_lead=None):
+def get_all_leads_for_client(client_id, visitor_converted_lead=None, lead_email=None):
     """
-    Returns ALL lead names associated with a client_id.
-    
+    Returns (lead_names, email_lead).
+
+    lead_names: ALL lead names associated with a client_id.
     Why: Multiple people can share a browser (same client_id) but each
     submits with their own email → multiple leads with same ga_client_id.
     Activities must fan out to all of them.
-    
     Also includes cross-device leads found via visitor.converted_lead.
+
+    email_lead: the newest lead matching lead_email (name, ga_client_id),
+    fetched by the same query so cross-device lookup costs no extra round-trip.
+
+    The client_id -> lead names part is cached in Redis (leads_for_client_key),
+    so anonymous page views and clicks don't hit CRM Lead at all; it is
+    cleared (after commit) wherever a lead's ga_client_id is written and by
+    the CRM Lead doc_events.
     """
     lead_names = set()
+    email_lead = None
 
     if visitor_converted_lead:
         lead_names.add(visitor_converted_lead)
 
-    if client_id:
-        matches = frappe.get_all(
-            "CRM Lead",
-            filters={"ga_client_id": client_id},
-            pluck="name"
+    cache = frappe.cache()
+    cache_key = leads_for_client_key(client_id) if client_id else None
+
+    if cache_key and not lead_email:
+        cached = cache.get_value(cache_key)
+        if cached is not None:
+            lead_names.update(cached)
+            return list(lead_names), None
+
+    if client_id or lead_email:
+        rows = frappe.db.sql("""
+            SELECT name, email, ga_client_id
+            FROM `tabCRM Lead`
+            WHERE ga_client_id = %(client_id)s OR email = %(email)s
+            ORDER BY creation DESC
+        """, {"client_id": client_id or None, "email": lead_email or None}, as_dict=True)
+
+        client_leads = []
+        for row in rows:
+            if client_id and row.ga_client_id == client_id:
+                client_leads.append(row.name)
+            if lead_email and not email_lead and (row.email or "").lower() == lead_email:
+                email_lead = row
+        lead_names.update(client_leads)
+
+        if cache_key:
+            cache.set_value(cache_key, client_leads, expires_in_sec=LEADS_FOR_CLIENT_TTL_SEC)
+
+    return list(lead_names), email_lead
+
+
+ACTIVITY_QUEUE_PREFIX = "activity_queue:"
+# Orgs that have ever queued an activity, so the flush also drains queues
+# of orgs that have since been removed from the tracking config
+ACTIVITY_QUEUE_ORGS_KEY = "activity_queue_orgs"
+# Payloads that failed to build, kept per org instead of being dropped
+ACTIVITY_DEAD_LETTER_PREFIX = "activity_queue_failed:"
+ACTIVITY_FLUSH_LOCK_KEY = "activity_queue_flush_lock"
+ACTIVITY_FLUSH_LOCK_SEC = 300
+ACTIVITY_FLUSH_BATCH = 10_000
+
+
+def queue_activity(org_name, lead_names, activity_dict):
+    """
+    Defer an activity write: push it onto the org's Redis list.
+    flush_activity_queue() bulk-inserts the backlog from the scheduler.
+    """
+    cache = frappe.cache()
+    cache.rpush(
+        f"{ACTIVITY_QUEUE_PREFIX}{org_name}",
+        json.dumps({"leads": lead_names, "activity": activity_dict}, default=str)
+    )
+    cache.sadd(ACTIVITY_QUEUE_ORGS_KEY, org_name)
+
+
+def _build_queued_activities(raw_items):
+    """
+    Turn queued activity payloads into ready-to-insert Communications.
+
+    References are resolved here, for the whole batch, with one query per
+    doctype: the payload's leads if they still exist, else the lead the
+    visitor has converted to since the event was queued (its history was
+    already relinked, so the activity must go straight to the lead), else
+    the Web Visitor. Returns (comms, failed_raw_items).
+    """
+    payloads, failed = [], []
+    for raw in raw_items:
+        try:
+            payloads.append((raw, json.loads(raw)))
+        except Exception as e:
+            frappe.logger().error("[activity_queue] Unparseable payload: %s", e)
+            failed.append(raw)
+
+    client_ids = {p["activity"].get("client_id") for _, p in payloads} - {None, ""}
+    visitors = {
+        v.client_id: v for v in frappe.get_all(
+            "Web Visitor",
+            filters={"client_id": ("in", list(client_ids))},
+            fields=["name", "client_id", "converted_lead"],
+        )
+    } if client_ids else {}
+
+    lead_names = {ln for _, p in payloads for ln in p.get("leads") or []}
+    lead_names.update(v.converted_lead for v in visitors.values() if v.converted_lead)
+    lead_emails = {
+        row.name: row.email or "" for row in frappe.get_all(
+            "CRM Lead", filters={"name": ("in", list(lead_names))}, fields=["name", "email"]
+        )
+    } if lead_names else {}
+
+    comms = []
+    timestamp = now()
+    for raw, payload in payloads:
+        try:
+            activity = payload["activity"]
+            visitor = visitors.get(activity.get("client_id"))
+            refs = [("CRM Lead", ln) for ln in payload.get("leads") or [] if ln in lead_emails]
+            if not refs and visitor and visitor.converted_lead in lead_emails:
+                refs = [("CRM Lead", visitor.converted_lead)]
+            if not refs and visitor:
+                refs = [("Web Visitor", visitor.name)]
+            if not refs:
+                raise ValueError(f"No lead or Web Visitor for client_id {activity.get('client_id')!r}")
+
+            for doctype, name in refs:
+                comm = new_activity_communication(
+                    doctype, name, lead_emails.get(name, "") if doctype == "CRM Lead" else "", activity
+                )
+                comm.set_new_name()
+                comm.owner = comm.modified_by = "Guest"
+                comm.creation = comm.modified = timestamp
+                comms.append(comm)
+        except Exception as e:
+            frappe.logger().error("[activity_queue] Unbuildable payload: %s", e)
+            failed.append(raw)
+
+    return comms, failed
+
+
+def flush_activity_queue():
+    """
+    Scheduler job: drain every org's activity queue and bulk-insert
+    the Communications in one go instead of one INSERT per event.
+
+    Items are trimmed from Redis only after the insert is committed, so a
+    failed or killed run leaves them queued for the next one. A lock keeps
+    overlapping runs from inserting the same items twice.
+    """
+    from frappe.model.document import bulk_insert
+
+    cache = frappe.cache()
+    if not cache.set(cache.make_key(ACTIVITY_FLUSH_LOCK_KEY), 1, ex=ACTIVITY_FLUSH_LOCK_SEC, nx=True):
+        frappe.logger().info("[activity_queue] Flush already running, skipping")
+        return
+
+    try:
+        config = get_organization_config_cached() or {}
+        org_names = {org["org_name"] for org in config.values()}
+        org_names.update(
+            o.decode() if isinstance(o, bytes) else o
+            for o in cache.smembers(ACTIVITY_QUEUE_ORGS_KEY) or ()
         )
-        lead_names.update(matches)
 
-    return list(lead_names)
+        for org_name in org_names:
+            key = f"{ACTIVITY_QUEUE_PREFIX}{org_name}"
+            raw_items = cache.lrange(key, 0, ACTIVITY_FLUSH_BATCH - 1)
+            if not raw_items:
+                continue
+
+            try:
+                comms, failed = _build_queued_activities(raw_items)
+                bulk_insert("Communication", comms, chunk_size=10_000)
+                frappe.db.commit()
+            except Exception:
+                # Nothing was trimmed: the batch stays queued and is retried next run
+                frappe.db.rollback()
+                frappe.log_error(frappe.get_traceback(), f"Activity Queue Flush Error: {org_name}")
+                continue
+
+            # Payloads that could not be built are kept for inspection, not dropped
+            if failed:
+                cache.rpush(f"{ACTIVITY_DEAD_LETTER_PREFIX}{org_name}", *failed)
+                frappe.log_error(
+                    f"{len(failed)} payload(s) moved to {ACTIVITY_DEAD_LETTER_PREFIX}{org_name}",
+                    f"Activity Queue Bad Payloads: {org_name}"
+                )
+
+            # Drop only what was committed; events pushed meanwhile stay queued
+            cache.ltrim(key, len(raw_items), -1)
+            frappe.logger().info("[activity_queue] Flushed %s event(s) for %s", len(raw_items), org_name)
+    finally:
+        cache.delete_value(ACTIVITY_FLUSH_LOCK_KEY)
 
 
 @frappe.whitelist(allow_guest=True, methods=["POST"])
 def track_activity(**kwargs):
-    """Universal Activity Tracker (Old logic + Facebook Ads support)"""
-
+    """
+    Universal Activity Tracker endpoint.
+    Only validates the beacon; the writes happen in _process_track on a
+    background job so the browser isn't kept waiting.
+    """
     frappe.set_user("Guest")
     frappe.flags.ignore_csrf = True
 
     try:
         data = get_request_data()
         data.update(kwargs)
-        org_config = identify_organization(data)
-        org_name = org_config["org_name"]
 
+        org_config = identify_organization_for_client(data)
+        org_name = org_config["org_name"]
         if not verify_organization_exists(org_name):
             return {
                 "success": False,
                 "message": f"Organization '{org_name}' not configured."
             }
 
-        frappe.logger().info(f"Activity tracking for: {org_name}")
+        client_id = _pick(data, "client_id")
+        if not client_id or not _pick(data, "activity_type"):
+            return {
+                "success": False,
+                "message": "client_id and activity_type required"
+            }
+
+        capture_request_context(data)
+        return enqueue_tracking_job(_process_track, data, client_id, "act", org_config=org_config)
+
+    except Exception as e:
+        frappe.logger().error("ACTIVITY TRACKING ERROR: %s", e)
+        frappe.log_error(frappe.get_traceback(), "Track Activity Error")
+        return {"success": False, "message": str(e)}
+
+
+def _process_track(data, org_config=None):
+    """
+    Universal Activity Tracker (Old logic + Facebook Ads support).
+    Runs on the short queue; expects data to have been through
+    capture_request_context, and the org_config that track_activity
+    already resolved and verified.
+    """
+    try:
+        if org_config is None:
+            org_config = identify_organization_for_client(data)
+            if not verify_organization_exists(org_config["org_name"]):
+                return {
+                    "success": False,
+                    "message": f"Organization '{org_config['org_name']}' not configured."
+                }
+        org_name = org_config["org_name"]
+
+        frappe.logger().info("Activity tracking for: %s", org_name)
 
-        client_id = data.get("ga_client_id") or data.get("client_id")
-        activity_type = str(data.get("activity_type") or data.get("event") or "")
-        page_url = str(data.get("page_url") or data.get("page_location") or "")
+        client_id = _pick(data, "client_id")
+        activity_type = _pick(data, "activity_type")
+        page_url = _pick(data, "page_url")
 
         if not client_id or not activity_type:
             return {
@@ -1169,34 +1632,17 @@ def track_activity(**kwargs):
                 "message": "client_id and activity_type required"
             }
 
-        from campaign_management.clients.base import (
-            extract_browser_details,
-            get_geo_info_from_ip,
-            get_or_create_web_visitor,
-            link_web_visitor_to_lead,
-            add_activity_to_lead,
-            get_utm_params_from_data,
-            track_facebook_ad_click,
-            link_historical_activities_to_lead
-        )
-
         if activity_type == "Facebook Ad Click" or data.get("fbclid"):
-            frappe.logger().info(f"Processing Facebook Ad Click for client_id={client_id}")
+            frappe.logger().info("Processing Facebook Ad Click for client_id=%s", client_id)
             track_facebook_ad_click(client_id, data, org_name)
 
-        user_agent = str(
-            data.get("user_agent") or
-            frappe.get_request_header("User-Agent", "")
-        )
-
-        ip_address = str(
-            data.get("ip_address") or
-            frappe.local.request_ip or ""
-        )
+        user_agent = data.get("user_agent") or ""
+        ip_address = data.get("ip_address") or ""
 
-        referrer = str(data.get("referrer") or data.get("page_referrer") or "")
+        referrer = _pick(data, "referrer")
 
         browser_details = extract_browser_details(user_agent)
+        browser_str = f"{browser_details['browser']} on {browser_details['os']}"
         geo_info = get_geo_info_from_ip(ip_address)
         utm_params = get_utm_params_from_data(data)
 
@@ -1207,27 +1653,22 @@ def track_activity(**kwargs):
             geo_location = geo_info["country"]
 
         data["user_agent"] = user_agent
-        #visitor = get_or_create_web_visitor(client_id, data)
+        # Also bumps last_seen; everything below is committed once at the end
         visitor = get_or_create_web_visitor(client_id, data)
 
-        frappe.db.set_value(
-            "Web Visitor",
-            visitor.name,
-            "last_seen",
-            now(),
-            update_modified=False
-        )
-
         
-        # --- Fan-out: find ALL leads for this client_id ---
-        all_lead_names = get_all_leads_for_client(
+        lead_email = str(data.get("lead_email") or "").strip().lower()
+
+        # --- Fan-out: find ALL leads for this client_id (+ cross-device email lead) ---
+        all_lead_names, email_lead = get_all_leads_for_client(
             client_id,
-            visitor_converted_lead=visitor.converted_lead if visitor else None
+            visitor_converted_lead=visitor.converted_lead if visitor else None,
+            lead_email=lead_email
         )
 
         frappe.logger().info(
-            f"[track_activity] client_id={client_id} → "
-            f"{len(all_lead_names)} lead(s): {all_lead_names}"
+            "[track_activity] client_id=%s → %s lead(s): %s",
+            client_id, len(all_lead_names), all_lead_names
         )
 
         utm_for_enrich = get_utm_params_from_data(data)
@@ -1260,30 +1701,23 @@ def track_activity(**kwargs):
                         org_config=org_config 
                     )
                     lead_doc.save(ignore_permissions=True)
-                    frappe.logger().info(f"[track_activity] Enriched lead {ln}")
+                    frappe.logger().info("[track_activity] Enriched lead %s", ln)
 
             except Exception as enrich_err:
                 frappe.logger().error(
-                    f"[track_activity] Enrichment failed for {ln}: {str(enrich_err)}"
+                    "[track_activity] Enrichment failed for %s: %s", ln, enrich_err
                 )
                 frappe.log_error(frappe.get_traceback(), "track_activity Enrichment Error")
 
         # For activity logging purposes, use first lead (or None = store on visitor)
         lead_name = all_lead_names[0] if all_lead_names else None
 
-        lead_email = str(data.get("lead_email") or "").strip().lower()
-        if lead_email:
+        if email_lead:
             try:
-                email_lead = frappe.db.get_value(
-                    "CRM Lead",
-                    {"email": lead_email},
-                    ["name", "ga_client_id"],
-                    as_dict=True
-                )
-                if email_lead and email_lead.name not in all_lead_names:
+                if email_lead.name not in all_lead_names:
                     frappe.logger().info(
-                        f"[track_activity] Cross-device: found lead {email_lead.name} "
-                        f"via email={lead_email}"
+                        "[track_activity] Cross-device: found lead %s via email=%s",
+                        email_lead.name, lead_email
                     )
                     all_lead_names.append(email_lead.name)
                     lead_name = lead_name or email_lead.name
@@ -1295,6 +1729,7 @@ def track_activity(**kwargs):
                             "ga_client_id", client_id,
                             update_modified=False
                         )
+                        clear_leads_for_client(client_id)
                         
                         
                     # Also link visitor and migrate historical activities
@@ -1319,24 +1754,24 @@ def track_activity(**kwargs):
                                 org_config=org_config
                             )
                             cd_lead_doc.save(ignore_permissions=True)
-                            frappe.logger().info(f"[track_activity] Cross-device lead {email_lead.name} enriched")
+                            frappe.logger().info("[track_activity] Cross-device lead %s enriched", email_lead.name)
                         except Exception as ce:
-                            frappe.logger().error(f"[track_activity] Cross-device enrichment failed: {str(ce)}")
+                            frappe.logger().error("[track_activity] Cross-device enrichment failed: %s", ce)
 
             except Exception as e:
                 frappe.logger().error(
-                    f"[track_activity] Cross-device email lookup failed: {str(e)}"
+                    "[track_activity] Cross-device email lookup failed: %s", e
                 )
 
         
-        activity_type_raw = str(data.get("activity_type") or data.get("event") or "")
+        activity_type_raw = _pick(data, "activity_type")
         element_text = str(data.get("element_text") or "").strip()
         element_href = str(data.get("element_href") or "").strip()
         nav_item     = str(data.get("nav_item") or "").strip()
         tab_name     = str(data.get("tab_name") or "").strip()
         dom_path     = str(data.get("dom_path") or "").strip()
         page_title   = str(data.get("page_title") or "").strip()
-        cta_name     = str(data.get("cta_name") or data.get("link_name") or "").strip()
+        cta_name     = _pick(data, "cta_name").strip()
         cta_location = str(data.get("cta_location") or "").strip()
         href_clean   = element_href.split("?")[0] if element_href else ""
 
@@ -1372,7 +1807,7 @@ def track_activity(**kwargs):
             activity_type = f"Page View | {page_title}" if page_title else "Page View"
 
         elif activity_type_raw == "form_start":
-            fname = str(data.get("form_name") or data.get("form_id") or "").strip()
+            fname = _pick(data, "form_name").strip()
             activity_type = f"Form Started | {fname}" if fname else "Form Started"
 
         else:
@@ -1383,12 +1818,7 @@ def track_activity(**kwargs):
         if not cta_location:
             cta_location = dom_path or activity_type_raw
 
-        tracked_item = (
-            data.get("product_name")
-            or data.get("feature_name")
-            or data.get("service_name")
-            or ""
-        )
+        tracked_item = _pick(data, "tracked_item")
 
         # Build activity dict once, fan out to ALL leads sharing this client_id
         activity_dict = {
@@ -1400,7 +1830,7 @@ def track_activity(**kwargs):
             "element_href": element_href,
             "dom_path": dom_path,
             "timestamp": now(),
-            "browser": f"{browser_details['browser']} on {browser_details['os']}",
+            "browser": browser_str,
             "device": browser_details["device"],
             "geo_location": geo_location,
             "referrer": referrer,
@@ -1409,10 +1839,15 @@ def track_activity(**kwargs):
             **utm_params
         }
 
-        if all_lead_names:
-            for ln in all_lead_names:
-                add_activity_to_lead(ln, activity_dict)
-            activity_saved = True
+        # activity_saved reports a written Communication; a queued one is
+        # only written by the next flush_activity_queue run
+        activity_queued = False
+        if not frappe.conf.get("campaign_sync_activity_writes"):
+            # Default: defer the Communication insert to flush_activity_queue
+            queue_activity(org_name, all_lead_names, activity_dict)
+            activity_saved, activity_queued = False, True
+        elif all_lead_names:
+            activity_saved = all([add_activity_to_lead(ln, activity_dict) for ln in all_lead_names])
         else:
             # No leads yet — store against visitor for future migration
             activity_saved = add_activity_to_lead(None, activity_dict)
@@ -1425,11 +1860,12 @@ def track_activity(**kwargs):
             "linked_leads": all_lead_names,
             "organization": org_name,
             "activity_saved": activity_saved,
+            "activity_queued": activity_queued,
             "device_detected": browser_details["device"],
             "utm_captured": {k: v for k, v in utm_params.items() if v}
         }
 
     except Exception as e:
-        frappe.logger().error(f"ACTIVITY TRACKING ERROR: {str(e)}")
+        frappe.logger().error("ACTIVITY TRACKING ERROR: %s", e)
         frappe.log_error(frappe.get_traceback(), "Track Activity Error")
         return {"success": False, "message": str(e)}
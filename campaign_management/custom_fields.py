@@ -1,281 +1,311 @@
+import hashlib
+import json
+
+import frappe
 from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
 
-def get_custom_fields():
-    return {
-        "CRM Lead": [
-            {"fieldname": "ga_client_id", "label": "GA4 Client ID", "fieldtype": "Data", "insert_after": "email_id", "in_list_view": 1, "in_standard_filter": 1, "bold": 1, "description": "Auto-captured from Google Analytics 4"},
-            
-            {"fieldname": "campaign_section", "label": "Campaign Information", "fieldtype": "Section Break", "insert_after": "lead_owner"},
-
-            {"fieldname": "utm_source",
-             "label": "UTM Source",
-             "fieldtype": "Select",
-             "options": "\nGoogle\nFacebook\nLinkedIn\nTwitter\nInstagram\nEmail\nDirect\nReferral\nOrganic\nBing\nYouTube\nTikTok\nWhatsApp\nOther",
-             "insert_after": "campaign_section",
-             "in_list_view": 1,
-             "in_standard_filter": 1},
-
-            {"fieldname": "source_type",
-             "label": "Source Type",
-             "fieldtype": "Select",
-             "options": "Landing Page\nForm",
-             "insert_after": "utm_source",
-             "in_list_view": 1,
-             "in_standard_filter": 1},
-
-            {"fieldname": "utm_medium",
-             "label": "UTM Medium",
-             "fieldtype": "Select",
-             "options": "\nCPC\nPPC\nCPM\nDisplay\nSocial\nEmail\nAffiliate\nReferral\nOrganic\nPaid Social\nBanner\nRetargeting\nVideo\nOther",
-             "insert_after": "source_type",
-             "in_standard_filter": 1},
-
-            {"fieldname": "source_name",
-             "label": "Source Name",
-             "fieldtype": "Data",
-             "insert_after": "utm_medium",
-             "in_list_view": 1},
-
-            {"fieldname": "utm_campaign",
-             "label": "UTM Campaign",
-             "fieldtype": "Data",
-             "insert_after": "source_name"},
-
-            {"fieldname": "utm_campaign_id",
-             "label": "UTM Campaign ID",
-             "fieldtype": "Data",
-             "insert_after": "utm_campaign",
-             "description": "Campaign ID from advertising platforms (utm_id)"},
-
-            # ✅ Ad Tracking Section
-            {"fieldname": "ad_tracking_section",
-             "label": "Ad Click Tracking",
-             "fieldtype": "Section Break",
-             "insert_after": "utm_campaign_id",
-             "collapsible": 1},
-
-            {"fieldname": "ad_platform",
-             "label": "Ad Platform",
-             "fieldtype": "Select",
-             "options": "\nFacebook/Instagram\nGoogle Ads\nLinkedIn Ads\nMicrosoft Ads\nTwitter Ads\nTikTok Ads\nOther",
-             "insert_after": "ad_tracking_section",
-             "in_list_view": 1,
-             "in_standard_filter": 1,
-             "description": "Automatically detected from click ID parameter"},
-
-            {"fieldname": "ad_click_id",
-             "label": "Ad Click ID",
-             "fieldtype": "Data",
-             "insert_after": "ad_platform",
-             "in_list_view": 1,
-             "description": "Unique identifier from ad platform (fbclid, gclid, msclkid, etc.)"},
-
-            {"fieldname": "ad_tracking_column",
-             "fieldtype": "Column Break",
-             "insert_after": "ad_click_id"},
-
-            {"fieldname": "ad_click_timestamp",
-             "label": "Ad Click Time",
-             "fieldtype": "Datetime",
-             "insert_after": "ad_tracking_column",
-             "read_only": 1,
-             "description": "When the ad was clicked"},
-
-            {"fieldname": "ad_landing_page",
-             "label": "Ad Landing Page",
-             "fieldtype": "Data",
-             "insert_after": "ad_click_timestamp",
-             "read_only": 1,
-             "description": "First page visited from ad click"},
-
-            {"fieldname": "ad_click_id_full",
-             "label": "Ad Click ID (Full)",
-             "fieldtype": "Long Text",
-             "insert_after": "ad_click_id",
-             "description": "Full ad click identifier (fbclid, gclid, msclkid, etc.)"},
-
-            
-            {"fieldname": "lead_company",
-             "label": "Lead Company",
-             "fieldtype": "Data",
-             "insert_after": "ad_landing_page",
-             "description": "Company/Business the lead represents"},
-
-            # {"fieldname": "country",
-            #  "label": "Country",
-            #  "fieldtype": "Data",  
-            #  "insert_after": "lead_company",
-            #  "in_list_view": 0,
-            #  "in_standard_filter": 1,
-            #  "description": "Lead's country"
-            # },
-            
-            {
-                "fieldname": "tracking_organization",
-                "label": "Tracking Organization",
-                "fieldtype": "Link",
-                "options": "Tracking Organization",
-                "insert_after": "organization",   # sits right next to CRM Organization for visibility
-                "in_list_view": 0,
-                "in_standard_filter": 1,
-                "read_only": 0,
-                "description": "Source website/tracking origin for this lead"
-            },
-                        
-
-            {"fieldname": "campaign_lead_link",
-             "label": "Campaign Lead",
-             "fieldtype": "Link",
-             "options": "Campaign Lead",
-             "insert_after": "lead_company",
-             "in_list_view": 1,
-             "description": "Click to view detailed tracking information"},
-
-            {"fieldname": "page_url",
-             "label": "Page URL",
-             "fieldtype": "Data",
-             "insert_after": "campaign_lead_link"},
-
-            {"fieldname": "page_url_full",
-             "label": "Page URL (Full)",
-             "fieldtype": "Long Text",
-             "insert_after": "page_url",
-             "description": "Full URL with UTM and ad parameters"},
-
-            {"fieldname": "campaign_column",
-             "fieldtype": "Column Break",
-             "insert_after": "page_url"},
-
-            {"fieldname": "referrer",
-             "label": "Referrer",
-             "fieldtype": "Data",
-             "insert_after": "campaign_column"},
-
-            # {"fieldname": "tracking_info",
-            #  "label": "Tracking Information",
-            #  "fieldtype": "Code",
-            #  "options": "JSON",
-            #  "insert_after": "referrer"},
-
-            {"fieldname": "full_tracking_details",
-             "label": "Full Tracking Details",
-             "fieldtype": "Code",
-             "options": "JSON",
-             "insert_after": "tracking_info",
-             "read_only": 1,
-             "description": "Complete tracking data including browser, device, geo, and client info"},
-        ],
-
-        "CRM Organization": [
-            {"fieldname": "analytics_section",
-             "label": "Analytics",
-             "fieldtype": "Section Break",
-             "insert_after": "website"},
-
-            {"fieldname": "looker_studio_url",
-             "label": "Looker Studio Dashboard",
-             "fieldtype": "Data",
-             "insert_after": "analytics_section",
-             "description": "Embedded Looker Studio URL for GA4 analytics dashboard"},
-
-            {"fieldname": "analytics_column",
-             "fieldtype": "Column Break",
-             "insert_after": "looker_studio_url"},
-
-            {"fieldname": "ga4_property_id",
-             "label": "GA4 Property ID",
-             "fieldtype": "Data",
-             "insert_after": "analytics_column",
-             "description": "Google Analytics 4 Property ID (optional)"},
-
-            
-            {"fieldname": "advertising_section",
-             "label": "Advertising & Conversion Tracking",
-             "fieldtype": "Section Break",
-             "insert_after": "ga4_property_id",
-             "collapsible": 1},
-
-            # {"fieldname": "facebook_pixel_id",
-            #  "label": "Facebook Pixel ID",
-            #  "fieldtype": "Data",
-            #  "insert_after": "advertising_section",
-            #  "description": "Facebook/Instagram Pixel ID for conversion tracking"},
-
-            # {"fieldname": "google_ads_conversion_id",
-            #  "label": "Google Ads Conversion ID",
-            #  "fieldtype": "Data",
-            #  "insert_after": "facebook_pixel_id",
-            #  "description": "Google Ads Conversion Tracking ID"},
-        ],
-        
-        
-        "Tracking Organization": [
-
-            {
-                "fieldname": "meta_section",
-                "label": "Meta CAPI Configuration",
-                "fieldtype": "Section Break",
-                "insert_after": "crm_organization"
-            },
-
-            {
-                "fieldname": "facebook_pixel_id",
-                "label": "Facebook Pixel ID",
-                "fieldtype": "Data",
-                "insert_after": "meta_section"
-            },
-            
-            {
-                "fieldname": "meta_access_token_capi",
-                "label": "Meta Access Token (CAPI)",
-                "fieldtype": "Long Text",
-                "insert_after": "facebook_pixel_id",
-                "description": "Meta Conversions API long-lived access token."
-            },
-
-            # {
-            #     "fieldname": "facebook_access_token",
-            #     "label": "Facebook Access Token",
-            #     "fieldtype": "Password",
-            #     "insert_after": "facebook_pixel_id"
-            # },
-
-            # {
-            #     "fieldname": "meta_dataset_id",
-            #     "label": "Meta Dataset ID",
-            #     "fieldtype": "Data",
-            #     "insert_after": "facebook_access_token"
-            # },
-
-            {
-                "fieldname": "meta_test_event_code",
-                "label": "Meta Test Event Code",
-                "fieldtype": "Data",
-                "insert_after": "meta_access_token_capi"
-            },
-
-            {
-                "fieldname": "ga4_section",
-                "label": "GA4 Configuration",
-                "fieldtype": "Section Break",
-                "insert_after": "meta_test_event_code"
-            },
-
-            {
-                "fieldname": "ga4_measurement_id",
-                "label": "GA4 Measurement ID",
-                "fieldtype": "Data",
-                "insert_after": "ga4_section"
-            },
-
-            {
-                "fieldname": "ga4_api_secret",
-                "label": "GA4 API Secret",
-                "fieldtype": "Password",
-                "insert_after": "ga4_measurement_id"
-            }
-        ]
+# DefaultValue key holding the hash of the last applied definitions
+_FIELDS_HASH_KEY = "campaign_management_custom_fields_hash"
+
+# Built once at import and reused by every after_migrate run
+_CRM_LEAD_FIELDS = (
+    {"fieldname": "ga_client_id", "label": "GA4 Client ID", "fieldtype": "Data", "insert_after": "email_id", "in_list_view": 1, "in_standard_filter": 1, "bold": 1, "description": "Auto-captured from Google Analytics 4"},
+
+    {"fieldname": "campaign_section", "label": "Campaign Information", "fieldtype": "Section Break", "insert_after": "lead_owner"},
+
+    {"fieldname": "utm_source",
+     "label": "UTM Source",
+     "fieldtype": "Select",
+     "options": "\nGoogle\nFacebook\nLinkedIn\nTwitter\nInstagram\nEmail\nDirect\nReferral\nOrganic\nBing\nYouTube\nTikTok\nWhatsApp\nOther",
+     "insert_after": "campaign_section",
+     "in_list_view": 1,
+     "in_standard_filter": 1},
+
+    {"fieldname": "source_type",
+     "label": "Source Type",
+     "fieldtype": "Select",
+     "options": "Landing Page\nForm",
+     "insert_after": "utm_source",
+     "in_list_view": 1,
+     "in_standard_filter": 1},
+
+    {"fieldname": "utm_medium",
+     "label": "UTM Medium",
+     "fieldtype": "Select",
+     "options": "\nCPC\nPPC\nCPM\nDisplay\nSocial\nEmail\nAffiliate\nReferral\nOrganic\nPaid Social\nBanner\nRetargeting\nVideo\nOther",
+     "insert_after": "source_type",
+     "in_standard_filter": 1},
+
+    {"fieldname": "source_name",
+     "label": "Source Name",
+     "fieldtype": "Data",
+     "insert_after": "utm_medium",
+     "in_list_view": 1},
+
+    {"fieldname": "utm_campaign",
+     "label": "UTM Campaign",
+     "fieldtype": "Data",
+     "insert_after": "source_name"},
+
+    {"fieldname": "utm_campaign_id",
+     "label": "UTM Campaign ID",
+     "fieldtype": "Data",
+     "insert_after": "utm_campaign",
+     "description": "Campaign ID from advertising platforms (utm_id)"},
+
+    # ✅ Ad Tracking Section
+    {"fieldname": "ad_tracking_section",
+     "label": "Ad Click Tracking",
+     "fieldtype": "Section Break",
+     "insert_after": "utm_campaign_id",
+     "collapsible": 1},
+
+    {"fieldname": "ad_platform",
+     "label": "Ad Platform",
+     "fieldtype": "Select",
+     "options": "\nFacebook/Instagram\nGoogle Ads\nLinkedIn Ads\nMicrosoft Ads\nTwitter Ads\nTikTok Ads\nOther",
+     "insert_after": "ad_tracking_section",
+     "in_list_view": 1,
+     "in_standard_filter": 1,
+     "description": "Automatically detected from click ID parameter"},
+
+    {"fieldname": "ad_click_id",
+     "label": "Ad Click ID",
+     "fieldtype": "Data",
+     "insert_after": "ad_platform",
+     "in_list_view": 1,
+     "description": "Unique identifier from ad platform (fbclid, gclid, msclkid, etc.)"},
+
+    {"fieldname": "ad_tracking_column",
+     "fieldtype": "Column Break",
+     "insert_after": "ad_click_id"},
+
+    {"fieldname": "ad_click_timestamp",
+     "label": "Ad Click Time",
+     "fieldtype": "Datetime",
+     "insert_after": "ad_tracking_column",
+     "read_only": 1,
+     "description": "When the ad was clicked"},
+
+    {"fieldname": "ad_landing_page",
+     "label": "Ad Landing Page",
+     "fieldtype": "Data",
+     "insert_after": "ad_click_timestamp",
+     "read_only": 1,
+     "description": "First page visited from ad click"},
+
+    {"fieldname": "ad_click_id_full",
+     "label": "Ad Click ID (Full)",
+     "fieldtype": "Long Text",
+     "insert_after": "ad_click_id",
+     "description": "Full ad click identifier (fbclid, gclid, msclkid, etc.)"},
+
+
+    {"fieldname": "lead_company",
+     "label": "Lead Company",
+     "fieldtype": "Data",
+     "insert_after": "ad_landing_page",
+     "description": "Company/Business the lead represents"},
+
+    # {"fieldname": "country",
+    #  "label": "Country",
+    #  "fieldtype": "Data",  
+    #  "insert_after": "lead_company",
+    #  "in_list_view": 0,
+    #  "in_standard_filter": 1,
+    #  "description": "Lead's country"
+    # },
+
+    {
+        "fieldname": "tracking_organization",
+        "label": "Tracking Organization",
+        "fieldtype": "Link",
+        "options": "Tracking Organization",
+        "insert_after": "organization",   # sits right next to CRM Organization for visibility
+        "in_list_view": 0,
+        "in_standard_filter": 1,
+        "read_only": 0,
+        "description": "Source website/tracking origin for this lead"
+    },
+
+
+    {"fieldname": "campaign_lead_link",
+     "label": "Campaign Lead",
+     "fieldtype": "Link",
+     "options": "Campaign Lead",
+     "insert_after": "lead_company",
+     "in_list_view": 1,
+     "description": "Click to view detailed tracking information"},
+
+    {"fieldname": "page_url",
+     "label": "Page URL",
+     "fieldtype": "Data",
+     "insert_after": "campaign_lead_link"},
+
+    {"fieldname": "page_url_full",
+     "label": "Page URL (Full)",
+     "fieldtype": "Long Text",
+     "insert_after": "page_url",
+     "description": "Full URL with UTM and ad parameters"},
+
+    {"fieldname": "campaign_column",
+     "fieldtype": "Column Break",
+     "insert_after": "page_url"},
+
+    {"fieldname": "referrer",
+     "label": "Referrer",
+     "fieldtype": "Data",
+     "insert_after": "campaign_column"},
+
+    # {"fieldname": "tracking_info",
+    #  "label": "Tracking Information",
+    #  "fieldtype": "Code",
+    #  "options": "JSON",
+    #  "insert_after": "referrer"},
+
+    {"fieldname": "full_tracking_details",
+     "label": "Full Tracking Details",
+     "fieldtype": "Code",
+     "options": "JSON",
+     "insert_after": "tracking_info",
+     "read_only": 1,
+     "description": "Complete tracking data including browser, device, geo, and client info"},
+)
+
+_CRM_ORG_FIELDS = (
+    {"fieldname": "analytics_section",
+     "label": "Analytics",
+     "fieldtype": "Section Break",
+     "insert_after": "website"},
+
+    {"fieldname": "looker_studio_url",
+     "label": "Looker Studio Dashboard",
+     "fieldtype": "Data",
+     "insert_after": "analytics_section",
+     "description": "Embedded Looker Studio URL for GA4 analytics dashboard"},
+
+    {"fieldname": "analytics_column",
+     "fieldtype": "Column Break",
+     "insert_after": "looker_studio_url"},
+
+    {"fieldname": "ga4_property_id",
+     "label": "GA4 Property ID",
+     "fieldtype": "Data",
+     "insert_after": "analytics_column",
+     "description": "Google Analytics 4 Property ID (optional)"},
+
+
+    {"fieldname": "advertising_section",
+     "label": "Advertising & Conversion Tracking",
+     "fieldtype": "Section Break",
+     "insert_after": "ga4_property_id",
+     "collapsible": 1},
+
+    # {"fieldname": "facebook_pixel_id",
+    #  "label": "Facebook Pixel ID",
+    #  "fieldtype": "Data",
+    #  "insert_after": "advertising_section",
+    #  "description": "Facebook/Instagram Pixel ID for conversion tracking"},
+
+    # {"fieldname": "google_ads_conversion_id",
+    #  "label": "Google Ads Conversion ID",
+    #  "fieldtype": "Data",
+    #  "insert_after": "facebook_pixel_id",
+    #  "description": "Google Ads Conversion Tracking ID"},
+)
+
+_TRACKING_ORG_FIELDS = (
+
+    {
+        "fieldname": "meta_section",
+        "label": "Meta CAPI Configuration",
+        "fieldtype": "Section Break",
+        "insert_after": "crm_organization"
+    },
+
+    {
+        "fieldname": "facebook_pixel_id",
+        "label": "Facebook Pixel ID",
+        "fieldtype": "Data",
+        "insert_after": "meta_section"
+    },
+
+    {
+        "fieldname": "meta_access_token_capi",
+        "label": "Meta Access Token (CAPI)",
+        "fieldtype": "Long Text",
+        "insert_after": "facebook_pixel_id",
+        "description": "Meta Conversions API long-lived access token."
+    },
+
+    # {
+    #     "fieldname": "facebook_access_token",
+    #     "label": "Facebook Access Token",
+    #     "fieldtype": "Password",
+    #     "insert_after": "facebook_pixel_id"
+    # },
+
+    # {
+    #     "fieldname": "meta_dataset_id",
+    #     "label": "Meta Dataset ID",
+    #     "fieldtype": "Data",
+    #     "insert_after": "facebook_access_token"
+    # },
+
+    {
+        "fieldname": "meta_test_event_code",
+        "label": "Meta Test Event Code",
+        "fieldtype": "Data",
+        "insert_after": "meta_access_token_capi"
+    },
+
+    {
+        "fieldname": "ga4_section",
+        "label": "GA4 Configuration",
+        "fieldtype": "Section Break",
+        "insert_after": "meta_test_event_code"
+    },
+
+    {
+        "fieldname": "ga4_measurement_id",
+        "label": "GA4 Measurement ID",
+        "fieldtype": "Data",
+        "insert_after": "ga4_section"
+    },
+
+    {
+        "fieldname": "ga4_api_secret",
+        "label": "GA4 API Secret",
+        "fieldtype": "Password",
+        "insert_after": "ga4_measurement_id"
     }
+)
+
+
+_FIELDS = {
+    "CRM Lead": _CRM_LEAD_FIELDS,
+    "CRM Organization": _CRM_ORG_FIELDS,
+    "Tracking Organization": _TRACKING_ORG_FIELDS,
+}
+
+
+def get_custom_fields():
+    # Shared, not copied: create_custom_fields only reads it
+    return _FIELDS
+
 
 def execute():
-    create_custom_fields(get_custom_fields())
\ No newline at end of file
+    """
+    after_migrate: create the custom fields, skipping the work when the
+    definitions are unchanged since the last run. The hash lives in
+    DefaultValue so it survives the cache flush that migrate does.
+    """
+    custom_fields = get_custom_fields()
+    fields_hash = hashlib.blake2b(
+        json.dumps(custom_fields, sort_keys=True).encode()
+    ).hexdigest()
+    if frappe.db.get_default(_FIELDS_HASH_KEY) == fields_hash:
+        return
+
+    create_custom_fields(custom_fields)
+    frappe.db.set_default(_FIELDS_HASH_KEY, fields_hash)
\ No newline at end of file
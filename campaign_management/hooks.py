@@ -5,12 +5,8 @@ app_description = "Landing Page & Campaign Builder"
 app_email = "rashmi@walue.biz"
 app_license = "MIT"
 
-# JavaScript includes (for Desk)
-app_include_js = [
-    "/assets/campaign_management/js/workspace_my_campaigns.js",
-    "/assets/campaign_management/js/gtm_body.js",
-    "/assets/campaign_management/js/crm_sidebar.js"
-]
+# JavaScript includes (for Desk) - one bundle instead of a script tag per file
+app_include_js = ["campaign_management.bundle.js"]
 
 # Head includes for website (GTM head script)
 app_include_head = [
@@ -31,8 +27,32 @@ website_route_rules = [
 ]
 
 
-# Fixtures 
-fixtures = []  # Temporarily empty moved to code-based fields
-
-# Add this line for code-based custom fields (permanent fix)
+# Custom fields are code-based (custom_fields.py), not exported as fixtures
 after_migrate = ["campaign_management.custom_fields.execute"]
+
+# Keep the cached client_id -> leads mapping used by track_activity fresh,
+# and drop cached public page HTML when a page or its template changes
+doc_events = {
+    "CRM Lead": {
+        "on_update": "campaign_management.clients.base.on_lead_change",
+        "on_trash": "campaign_management.clients.base.on_lead_change"
+    },
+    "Landing Page": {
+        "on_update": "campaign_management.api.on_landing_page_change",
+        "on_trash": "campaign_management.api.on_landing_page_change"
+    },
+    "Landing Page Template": {
+        "on_update": "campaign_management.api.on_landing_page_template_change",
+        "on_trash": "campaign_management.api.on_landing_page_template_change"
+    }
+}
+
+# Bulk-insert activities queued by track_activity
+# (set campaign_sync_activity_writes in site config to write them inline instead)
+scheduler_events = {
+    "cron": {
+        "* * * * *": [
+            "campaign_management.clients.universal_tracker.flush_activity_queue"
+        ]
+    }
+}
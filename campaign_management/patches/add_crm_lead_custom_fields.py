@@ -1,7 +1,16 @@
 import frappe
+from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
 
 def execute():
-    """Add custom fields to CRM Lead for campaign tracking"""
+    """
+    Add custom fields to CRM Lead for campaign tracking.
+
+    Not listed in patches.txt: the fields the app relies on are created by
+    custom_fields.execute on every migrate. This is a one-off, run with
+    bench --site <site> execute campaign_management.patches.add_crm_lead_custom_fields.execute
+    Existing fields are never modified - utm_source / utm_medium are Select
+    fields in custom_fields.py and must not be turned back into Data here.
+    """
     
     custom_fields = {
         "CRM Lead": [
@@ -60,18 +69,22 @@ def execute():
         ]
     }
     
-    for doctype, fields in custom_fields.items():
-        for field in fields:
-            if not frappe.db.exists("Custom Field", {"dt": doctype, "fieldname": field["fieldname"]}):
-                custom_field = frappe.get_doc({
-                    "doctype": "Custom Field",
-                    "dt": doctype,
-                    **field
-                })
-                custom_field.insert(ignore_permissions=True)
-                print(f"✅ Added field: {field['fieldname']}")
-            else:
-                print(f"⏭️  Field already exists: {field['fieldname']}")
-                
-    frappe.db.commit()
-    print("✅ Custom fields setup complete")
+    # One lookup of what already exists; only the missing fields are sent
+    # to create_custom_fields, so the summary below is what was written
+    fields = custom_fields["CRM Lead"]
+    existing = set(frappe.get_all(
+        "Custom Field",
+        filters={"dt": "CRM Lead", "fieldname": ("in", [f["fieldname"] for f in fields])},
+        pluck="fieldname",
+    ))
+    missing = [f for f in fields if f["fieldname"] not in existing]
+
+    # update=False leaves existing fields untouched; the doctype cache is
+    # cleared once instead of once per field
+    if missing:
+        create_custom_fields({"CRM Lead": missing}, ignore_validate=True, update=False)
+
+    frappe.logger("campaign_mgmt").info({
+        "added": [f["fieldname"] for f in missing],
+        "skipped": sorted(existing),
+    })
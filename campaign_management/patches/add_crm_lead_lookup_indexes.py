@@ -0,0 +1,17 @@
+import frappe
+
+def execute():
+    """
+    Composite indexes for the tracker's CRM Lead lookups.
+
+    universal_tracker filters CRM Lead by ga_client_id (alone or with
+    organization) and by email (alone or with organization) on every
+    request; without these the lookups scan the whole table.
+
+    ga_client_id / email lead and organization follows: the org-scoped
+    lookups use both columns, while the org-less ones (activity fan-out,
+    find_lead_cross_device, QuickShop) can still use the index prefix.
+    (organization, ...) ordering would leave those to a full scan.
+    """
+    frappe.db.add_index("CRM Lead", ["ga_client_id", "organization"], "idx_lead_gacid_org")
+    frappe.db.add_index("CRM Lead", ["email", "organization"], "idx_lead_email_org")
@@ -0,0 +1,15 @@
+import frappe
+
+def execute():
+    """
+    Index Landing Page.slug.
+
+    serve_landing_page (every /lp/<slug> render) and
+    submit_landing_page_lead look pages up by slug; without an index those
+    lookups scan the whole table. The Landing Page DocType is not shipped
+    with this app, so the index is added here rather than via search_index
+    on the field.
+    """
+    if not frappe.db.table_exists("Landing Page"):
+        return
+    frappe.db.add_index("Landing Page", ["slug"], "idx_landing_page_slug")
@@ -0,0 +1,51 @@
+import frappe
+
+def execute():
+    """
+    Collapse duplicate Web Visitors (same client_id) into the oldest row so
+    the UNIQUE index on client_id can be created during model sync.
+
+    Communications and converted_lead from the duplicates are moved onto the
+    surviving visitor before the duplicates are deleted. Blank client_ids
+    are set to NULL: several '' values would also violate the index, while
+    NULLs don't.
+    """
+    if not frappe.db.table_exists("Web Visitor"):
+        return
+
+    frappe.db.sql("""
+        UPDATE `tabWeb Visitor`
+        SET client_id = NULL
+        WHERE client_id = ''
+    """)
+
+    duplicates = frappe.db.sql("""
+        SELECT client_id
+        FROM `tabWeb Visitor`
+        WHERE client_id IS NOT NULL
+        GROUP BY client_id
+        HAVING COUNT(*) > 1
+    """, pluck=True)
+
+    for client_id in duplicates:
+        visitors = frappe.get_all(
+            "Web Visitor",
+            filters={"client_id": client_id},
+            fields=["name", "converted_lead"],
+            order_by="creation asc"
+        )
+        keep, extras = visitors[0], visitors[1:]
+        extra_names = [v.name for v in extras]
+
+        frappe.db.sql("""
+            UPDATE `tabCommunication`
+            SET reference_name = %(keep)s
+            WHERE reference_doctype = 'Web Visitor' AND reference_name IN %(extras)s
+        """, {"keep": keep.name, "extras": extra_names})
+
+        if not keep.converted_lead:
+            converted_lead = next((v.converted_lead for v in extras if v.converted_lead), None)
+            if converted_lead:
+                frappe.db.set_value("Web Visitor", keep.name, "converted_lead", converted_lead)
+
+        frappe.db.delete("Web Visitor", {"name": ("in", extra_names)})
@@ -0,0 +1,4 @@
+// Desk scripts, built by esbuild into one asset (see app_include_js in hooks.py)
+import "./workspace_my_campaigns.js";
+import "./gtm_body.js";
+import "./crm_sidebar.js";
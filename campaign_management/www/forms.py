@@ -1,12 +1,19 @@
 import frappe
-from campaign_management.api import serve_dynamic_form
+from campaign_management.api import serve_dynamic_form, dynamic_form_html_key, PAGE_HTML_TTL_SEC
 
 def get_context(context):
     context.no_cache = 1
     path = frappe.request.path
-    slug = path.split("/forms/")[-1] if "/forms/" in path else None
+    _, sep, slug = path.rpartition("/forms/")
+    slug = slug if sep else None
     if slug:
-        context.html = serve_dynamic_form(slug=slug)
+        cache_key = dynamic_form_html_key(slug)
+        html = frappe.cache().get_value(cache_key)
+        if not html:
+            html = serve_dynamic_form(slug=slug)
+            if html:
+                frappe.cache().set_value(cache_key, html, expires_in_sec=PAGE_HTML_TTL_SEC)
+        context.html = html
     else:
         frappe.respond_as_web_page("Not Found", "Form not found", http_status_code=404)
     return context
@@ -1,13 +1,20 @@
 import frappe
-from campaign_management.api import serve_landing_page
+from campaign_management.api import serve_landing_page, landing_page_html_key, PAGE_HTML_TTL_SEC
 
 def get_context(context):
     context.no_cache = 1
     # Extract slug from path (e.g. /lp/my-campaign → slug = "my-campaign")
     path = frappe.request.path
-    slug = path.split("/lp/")[-1] if "/lp/" in path else None
+    _, sep, slug = path.rpartition("/lp/")
+    slug = slug if sep else None
     if slug:
-        context.html = serve_landing_page(slug=slug)
+        cache_key = landing_page_html_key(slug)
+        html = frappe.cache().get_value(cache_key)
+        if not html:
+            html = serve_landing_page(slug=slug)
+            if html:
+                frappe.cache().set_value(cache_key, html, expires_in_sec=PAGE_HTML_TTL_SEC)
+        context.html = html
     else:
         frappe.respond_as_web_page("Not Found", "Page not found", http_status_code=404)
     return context